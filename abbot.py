@@ -3,67 +3,33 @@
 import os, sys, getopt, json, resource
 from timeit import default_timer as timer
 
-# Our stuffs
-from slicer import Slicer
-from model import Model
-from optimizer import Optimizer
-from gcode import GCode
+# Our stuffs, the heavy modules (numpy, numpy-stl) are imported when needed
+from settings import init_configuration, merge_configuration, validate_configuration, check_model
 
 def usage():
     """ Print an help message """    
     print("usage: abbot.py [OPTIONS]")
     print("options:")
+    print(" -b file,  --batch=file    slices all the jobs of the manifest 'file'")
     print(" -c file,  --config=file   loads configuration from 'file'")
+    print(" -d addr,  --daemon=addr   run as a slicing server on 'addr' (host:port or socket path)")
     print(" -h,       --help          print this help message")
+    print(" -k,       --check         validate the configuration and the model files, then exit")
     print(" -m file,  --model=file    loads model from 'file'")
     print(" -o file,  --output=file   write the output to 'file'")
     print(" -v,       --verbose       be verbose")
 
-def init_configuration(config):
-    # Basic default configuration
-    # Distance are expressed in mm and speeds in mm/s
+def load_configuration(config, name):
+    """ Overrides the configuration with the settings of the JSON file 'name', exits on error """
 
-    config["verbose"] = False
-    config["output"] = None
-
-    # Printer
-    config["printer"] = dict()
-    config["printer"]["gcode"] = "marlin"
-    config["printer"]["min"] = [ 0, 0, 0 ]
-    config["printer"]["max"] = [ 200, 200, 200 ]
-    
-    # Extruder(s)
-    config["extruder"] = dict()        
-    config["extruder"]["nozzle_diameter"] = 0.35
-    config["extruder"]["filament_diameter"] = 1.75 
-    config["extruder"]["temperature"] = 200
-    config["extruder"]["offset_x"] = 0
-    config["extruder"]["offset_y"] = 0
-    config["extruder"]["fan_speed"] = 255
-    config["extruder"]["retract"] = dict()
-    config["extruder"]["retract"]["speed"] = 110
-    config["extruder"]["retract"]["distance"] = 4
-    
-    # Layer height
-    config["quality"] = 0.2
-    
-    # Speeds
-    config["speed"] = dict()
-    config["speed"]["print"] = 40
-    config["speed"]["travel"] = 150
-    config["speed"]["first_layer"] = 30
-    config["speed"]["outer_perimeter"] = 30
-    config["speed"]["inner_perimeter"] = 40
-    config["speed"]["infill"] = 60
-    config["speed"]["skin_infill"] = 30
-    
-    # Infill
-    config["filling_percent"] = 20    
+    try:
+        with open(name, "r") as f:
+            merge_configuration(config, json.load(f))
+    except Exception as err:
+        print(name + ": " + str(err))
+        sys.exit(1)
 
-    # Thickness
-    config["thickness"] = dict()
-    config["thickness"]["shell"] = 0.7
-    config["thickness"]["top_bottom"] = 0.6
+    return True
 
 def main(argv):
     """ Program entry point """
@@ -77,31 +43,34 @@ def main(argv):
 
     output = None
     verbose = False
+    daemon = None
+    batch = None
+    check = False
     
     try:
-        opts, args = getopt.getopt(argv, "c:hm:o:s:v", [ "config", "help", "model", "output", "set", "verbose" ])
+        opts, args = getopt.getopt(argv, "b:c:d:hkm:o:s:v", [ "batch=", "config=", "daemon=", "help", "check", "model=", "output=", "set=", "verbose" ])
     except getopt.GetoptError as err:
         print(str(err))
         usage()
         sys.exit(1)
 
     for o, a in opts:
-        if o == '-c':
-            try:
-                with open(a, "r") as f:
-                    config = json.load(f)
-                    config_loaded = True
-            except Exception as err:
-                print(str(err))
-                sys.exit(1)                
-        elif o == '-h':
+        if o in ('-b', '--batch'):
+            batch = a
+        elif o in ('-c', '--config'):
+            config_loaded = load_configuration(config, a)
+        elif o in ('-d', '--daemon'):
+            daemon = a
+        elif o in ('-h', '--help'):
             usage()
             sys.exit(0)
-        elif o == '-m':
+        elif o in ('-k', '--check'):
+            check = True
+        elif o in ('-m', '--model'):
             filenames.append(a)
-        elif o == '-o':
+        elif o in ('-o', '--output'):
             output = a
-        elif o == '-v':
+        elif o in ('-v', '--verbose'):
             verbose = True
         else:
             print("invalid option " + o)
@@ -110,24 +79,69 @@ def main(argv):
 
     # If no configuration has been specified, try to load default file 
     if not config_loaded and os.path.isfile("./abbot.json"):
-        try:
-            with open("./abbot.json", "r") as f:
-                config = json.load(f)
-        except Exception as err:
-            print(str(err))
-            sys.exit(1)                
+        load_configuration(config, "./abbot.json")
 
     if output != None:
         config["output"] = output
 
     config["verbose"] = verbose
 
+    # Registers the infill patterns to validate infill_pattern, without loading numpy
+    import fill
+
+    errors, warnings = validate_configuration(config)
+
+    for w in warnings:
+        print("warning: " + w, file = sys.stderr)
+
+    for e in errors:
+        print("error: " + e, file = sys.stderr)
+
+    if check:
+        failed = len(errors) > 0
+
+        for f in filenames:
+            try:
+                print(f + ": " + check_model(f))
+            except Exception as err:
+                print(f + ": " + str(err))
+                failed = True
+
+        sys.exit(1 if failed else 0)
+
+    if len(errors) > 0:
+        sys.exit(1)
+
+    if daemon != None:
+        from server import serve
+        serve(config, daemon)
+        return
+
+    if batch != None:
+        from batch import run_batch
+        try:
+            failed = run_batch(config, batch)
+        except Exception as err:
+            print(batch + ": " + str(err), file = sys.stderr)
+            sys.exit(1)
+        sys.exit(1 if failed > 0 else 0)
+
     total_start = timer()
     
     if len(filenames) == 0:
         print("no filenames specified")
         usage()
         sys.exit(1)
+    elif config["pipeline"]["enabled"]:
+        from pipeline import run_pipeline
+
+        config["filenames"] = filenames
+
+        try:
+            run_pipeline(config, filenames)
+        except Exception as err:
+            print(str(err), file = sys.stderr)
+            sys.exit(1)
     else:
         if verbose:
             print("Loading files ..." , file = sys.stderr, end = "")
@@ -135,30 +149,37 @@ def main(argv):
             
         start = timer()
 
+        from model import Model
+        from outofcore import MappedModel
+
         for f in filenames:
             try:
-                models.append(Model(f))
+                if config["outofcore"]["enabled"]:
+                    models.append(MappedModel(f, config))
+                else:
+                    models.append(Model(f, config))
                
             except Exception as err:
                 print("Loading " + f + ": " + str(err), file = sys.stderr)
                 return
 
+            r = models[-1].repaired
+            if verbose and r != None and r["degenerated"] + r["duplicated"] + r["flipped"] > 0:
+                print(" {0}: {1} degenerated and {2} duplicated facets removed, {3} flipped".format(f, r["degenerated"],
+                                                                                                    r["duplicated"],
+                                                                                                    r["flipped"]),
+                      file = sys.stderr, end = "")
+
         end = timer()
 
         if verbose:
             print(" done ({0:.2}s)".format(end - start), file = sys.stderr)
-            
-    config["filenames"] = filenames
-
-    # Let's go
-    slicer = Slicer(config, models)
-    slices = slicer.build_slicing_plan()
 
-    optimizer = Optimizer(config)
-    layers = optimizer.optimize(slices)
+        config["filenames"] = filenames
 
-    gcode = GCode(config)
-    gcode.dump(layers)
+        # Let's go
+        from process import process
+        process(config, models)
 
     total_end = timer()
     
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+import os, sys, copy, json
+from multiprocessing import Pool
+from timeit import default_timer as timer
+
+from model import Model
+from process import process
+from settings import merge_configuration, validate_configuration
+
+# Models shared by the jobs of a batch, set in each worker process
+models_cache = None
+
+def init_worker(models):
+    """ Worker initializer, models are inherited from the parent process """
+    global models_cache
+    models_cache = models
+
+def run_job(config, job):
+    """ Slices a single job of the batch, returns (output, elapsed time, error) """
+
+    start = timer()
+
+    try:
+        config = copy.deepcopy(config)
+        merge_configuration(config, job.get("config", {}))
+
+        errors, _ = validate_configuration(config)
+        if len(errors) > 0:
+            raise ValueError(errors[0])
+
+        config["verbose"] = False
+        config["filenames"] = job["models"]
+        config["output"] = job["output"]
+
+        models = [ models_cache[f].copy() for f in job["models"] ]
+
+        with open(job["output"], "w") as fd:
+            process(config, models, fd)
+    except Exception as err:
+        return job["output"], timer() - start, str(err)
+
+    return job["output"], timer() - start, None
+
+def load_manifest(name):
+    """ Loads a batch manifest: { "jobs": [ { "models": [ ... ], "config": { ... }, "output": "file" }, ... ] }
+        Relative paths are resolved from the directory of the manifest """
+
+    with open(name, "r") as f:
+        manifest = json.load(f)
+
+    root = os.path.dirname(os.path.abspath(name))
+    jobs = manifest["jobs"]
+
+    for job in jobs:
+        if len(job["models"]) == 0 or "output" not in job:
+            raise ValueError("job without models or output")
+
+        job["models"] = [ os.path.join(root, f) for f in job["models"] ]
+        job["output"] = os.path.join(root, job["output"])
+
+    return jobs
+
+def run_batch(config, name):
+    """ Slices all the jobs of a manifest, returns the number of failed jobs """
+
+    verbose = config["verbose"]
+
+    jobs = load_manifest(name)
+
+    # Load each mesh only once
+    start = timer()
+
+    models = dict()
+    errors = dict()
+    for job in jobs:
+        for f in job["models"]:
+            if f not in models and f not in errors:
+                try:
+                    models[f] = Model(f, config)
+                except Exception as err:
+                    errors[f] = "Loading " + f + ": " + str(err)
+
+    if verbose:
+        print("{0} jobs, {1} models loaded ({2:.2f}s)".format(len(jobs), len(models), timer() - start), file = sys.stderr)
+
+    workers = config["batch"]["workers"] or os.cpu_count()
+    failed = 0
+
+    # Jobs using a model that failed to load are not run
+    results = []
+    runnable = []
+
+    for job in jobs:
+        missing = [ errors[f] for f in job["models"] if f in errors ]
+        if len(missing) > 0:
+            results.append((job["output"], 0, missing[0]))
+        else:
+            runnable.append(job)
+
+    with Pool(workers, initializer = init_worker, initargs = (models, )) as pool:
+        results += pool.starmap(run_job, [ (config, job) for job in runnable ], chunksize = 1)
+
+        for output, elapsed, err in results:
+            if err != None:
+                failed += 1
+                print("{0}: {1}".format(output, err), file = sys.stderr)
+            elif verbose:
+                print(" {0} ({1:.2f}s)".format(output, elapsed), file = sys.stderr)
+
+    if verbose:
+        print("Batch done in {0:.2f}s, {1} failed".format(timer() - start, failed), file = sys.stderr)
+
+    return failed
@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+
+import os, sys, subprocess, tempfile
+from timeit import default_timer as timer
+
+# Startup time benchmark: per invocation overhead of abbot.py for the light and the full paths
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+MODEL = os.path.join(ROOT, "test", "box.stl")
+
+def measure(args, runs):
+    """ Runs abbot.py 'runs' times, returns the sorted wall times """
+    times = []
+
+    for i in range(runs):
+        start = timer()
+        subprocess.run([ sys.executable, os.path.join(ROOT, "abbot.py") ] + args,
+                       stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL, check = False)
+        times.append(timer() - start)
+
+    return sorted(times)
+
+def main(argv):
+    runs = int(argv[0]) if len(argv) > 0 else 10
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "box.gcode")
+
+        cases = [ ("help", [ "-h" ]),
+                  ("check", [ "--check", "-m", MODEL ]),
+                  ("slice", [ "-m", MODEL, "-o", output ]) ]
+
+        # Python itself, as a reference
+        start = timer()
+        for i in range(runs):
+            subprocess.run([ sys.executable, "-c", "pass" ], check = False)
+        print("{0:8s} {1:8.1f}ms".format("python", (timer() - start) / runs * 1000))
+
+        for name, args in cases:
+            times = measure(args, runs)
+            print("{0:8s} {1:8.1f}ms (min {2:.1f}ms)".format(name, times[len(times) // 2] * 1000, times[0] * 1000))
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import json
+import numpy as np
+
+# Keys of a report written by Estimator.write
+REPORT_KEYS = [ "time", "travel_time", "extrude_time", "travel_distance", "extrude_distance", "filament", "layers" ]
+
+def is_report(name):
+    """ Tells whether the file 'name' is an estimation report """
+
+    try:
+        with open(name, "r") as f:
+            report = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    return isinstance(report, dict) and sorted(report.keys()) == sorted(REPORT_KEYS)
+
+class Estimator:
+    """ Print time and filament estimation from the toolpaths, with trapezoidal speed profiles.
+
+        Each move accelerates from its entry speed up to its nominal speed and decelerates to
+        its exit speed. The speed at the junction of two moves is limited by the jerk (maximal
+        instantaneous speed change) and by what can be reached within the move lengths. """
+
+    def __init__(self, config):
+        self.config = config
+
+        self.acceleration = self.config["motion"]["acceleration"]
+        self.travel_acceleration = self.config["motion"]["travel_acceleration"]
+        self.jerk = self.config["motion"]["jerk"]
+
+        # Per layer results
+        self.layers = []
+
+    def plan(self, length, speed, accel, direction):
+        """ Returns the duration of each move of a sequence """
+
+        n = len(length)
+
+        # Junction speeds: the velocity change through the corner, speed * |u1 - u0| for unit
+        # directions u0 and u1, must not exceed the jerk
+        change = np.linalg.norm(direction[1:] - direction[:-1], axis = 1)
+        with np.errstate(divide = "ignore"):
+            corner = np.minimum(np.minimum(speed[1:], speed[:-1]), self.jerk / change)
+
+        # Squared speeds at the junctions, starting and ending at the jerk speed
+        w = np.concatenate([ [ min(self.jerk, speed[0]) ], corner, [ min(self.jerk, speed[-1]) ] ]) ** 2
+        d = 2 * accel * length
+
+        # Forward pass, w[i + 1] <= w[i] + d[i], solved as a running minimum:
+        # w[k] = min over j <= k of (w[j] + d[j] + ... + d[k - 1])
+        s = np.concatenate([ [ 0 ], np.cumsum(d) ])
+        w = s + np.minimum.accumulate(w - s)
+
+        # Backward pass, w[i] <= w[i + 1] + d[i]
+        w = (s[-1] - s) + np.minimum.accumulate((w - (s[-1] - s))[::-1])[::-1]
+
+        v0, v1 = np.sqrt(w[:n]), np.sqrt(w[1:])
+
+        # Trapezoid when the nominal speed is reached, triangle otherwise
+        cruise = length - (2 * speed ** 2 - v0 ** 2 - v1 ** 2) / (2 * accel)
+        peak = np.where(cruise >= 0, speed, np.sqrt(np.maximum((d + w[:n] + w[1:]) / 2, 0)))
+
+        return (2 * peak - v0 - v1) / accel + np.maximum(cruise, 0) / speed
+
+    def add_layer(self, z, moves):
+        """ Estimates a layer from its moves, an array of rows (x, y, z, extruded length, feedrate in mm/min, extruding).
+            Each row is the end of a move starting at the end of the previous one, the first row is the start position """
+
+        moves = np.asarray(moves, dtype = float).reshape(-1, 6)
+
+        if len(moves) < 2:
+            self.layers.append({ "z": float(z), "time": 0.0, "travel_time": 0.0, "extrude_time": 0.0,
+                                 "travel_distance": 0.0, "extrude_distance": 0.0, "filament": 0.0 })
+            return
+
+        delta = np.diff(moves[:, :3], axis = 0)
+        length = np.linalg.norm(delta, axis = 1)
+        speed = moves[1:, 4] / 60
+        extruding = moves[1:, 5] > 0
+        filament = float(np.sum(moves[1:, 3]))
+
+        # Zero length moves take no time
+        keep = length > 1e-9
+        length, speed, extruding, delta = length[keep], speed[keep], extruding[keep], delta[keep]
+
+        time = np.zeros(0)
+        if len(length) > 0:
+            accel = np.where(extruding, self.acceleration, self.travel_acceleration)
+            time = self.plan(length, speed, accel, delta / length[:, None])
+
+        self.layers.append({ "z": float(z),
+                             "time": float(np.sum(time)),
+                             "travel_time": float(np.sum(time[~extruding])),
+                             "extrude_time": float(np.sum(time[extruding])),
+                             "travel_distance": float(np.sum(length[~extruding])),
+                             "extrude_distance": float(np.sum(length[extruding])),
+                             "filament": filament })
+
+    def repeat_layer(self, z, layer):
+        """ Adds a layer with the same moves as an already estimated one """
+        self.layers.append(dict(layer, z = float(z)))
+
+    def report(self):
+        """ Returns the whole estimation as a dict """
+
+        total = lambda key: sum(l[key] for l in self.layers)
+
+        return { "time": total("time"),
+                 "travel_time": total("travel_time"),
+                 "extrude_time": total("extrude_time"),
+                 "travel_distance": total("travel_distance"),
+                 "extrude_distance": total("extrude_distance"),
+                 "filament": total("filament"),
+                 "layers": self.layers }
+
+    def write(self, name):
+        with open(name, "w") as f:
+            json.dump(self.report(), f, indent = 1)
@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
-from util import intercept2d
+import math
+
+# numpy is imported by the functions using it: importing this module only registers the
+# patterns, the configuration is validated without loading numpy
+from settings import register_choice
 
 class XFillLine():
     """ Filling line along X axis """
@@ -24,6 +28,8 @@ class XFillLine():
         return self.ypos >= self.ymin and self.ypos <= self.ymax
 
     def intersect(self, path, reverse = False):
+        from util import intercept2d
+
         prev = path[-1]
 
         for p in path:
@@ -59,6 +65,8 @@ class YFillLine():
         return self.xpos >= self.xmin and self.xpos <= self.xmax
 
     def intersect(self, path, reverse = False):
+        from util import intercept2d
+
         prev = path[-1]
 
         for p in path:
@@ -104,7 +112,10 @@ class GridPattern():
                 for path in paths:
                     self.xfill.intersect(path, not zig)
                 
-                assert(len(self.xfill.pts) % 2 == 0)
+                # An odd number of crossings means an open contour, skip the line rather than fill outside
+                if len(self.xfill.pts) % 2 != 0:
+                    zig = not zig
+                    continue
                 
                 it = iter(self.xfill.pts)
                 for p0, p1 in zip(it, it):
@@ -143,7 +154,10 @@ class GridPattern():
                 for path in paths:
                     self.yfill.intersect(path, not zig)
 
-                assert(len(self.yfill.pts) % 2 == 0)
+                # An odd number of crossings means an open contour, skip the line rather than fill outside
+                if len(self.yfill.pts) % 2 != 0:
+                    zig = not zig
+                    continue
             
                 it = iter(self.yfill.pts)
                 for p0, p1 in zip(it, it):
@@ -172,3 +186,230 @@ class GridPattern():
                     self.segments.append((x0, y0, x1, y1))
 
                 zig = not zig
+
+# Infill patterns. A pattern is a function (xmin, ymin, xmax, ymax, spacing, layer, z) returning
+# a list of polylines, (n, 2) arrays covering the bounding box. 'spacing' is the distance between
+# parallel lines giving the requested density for one family of lines.
+PATTERNS = dict()
+
+def register_pattern(name, factor = 1, period = 1):
+    """ Decorator registering an infill pattern. The spacing for a density d and a line width w is
+        factor * w / d, 'factor' being the length of lines per area unit of the pattern at spacing 1,
+        e.g. the number of families of parallel lines. The pattern repeats every 'period' layers,
+        None if it depends on the height """
+
+    def register(function):
+        PATTERNS[name] = (function, factor, period)
+        register_choice("infill_pattern", name)
+        return function
+
+    return register
+
+def pattern_period(name):
+    """ Returns the number of layers after which a pattern repeats, None if it never does """
+    return PATTERNS[name][2]
+
+def parallel_lines(xmin, ymin, xmax, ymax, spacing, angle):
+    """ Lines of direction 'angle' spaced by 'spacing', aligned on the origin so that successive
+        layers and regions share the same lines. Every other line is reversed (zig-zag) """
+
+    import numpy as np
+
+    u = np.array([ math.cos(angle), math.sin(angle) ])
+    n = np.array([ -u[1], u[0] ])
+
+    # Project the bounding box corners on the normal and on the direction
+    corners = np.array([ [ xmin, ymin ], [ xmax, ymin ], [ xmax, ymax ], [ xmin, ymax ] ])
+    pn, pu = corners @ n, corners @ u
+
+    offsets = np.arange(math.ceil(pn.min() / spacing), math.floor(pn.max() / spacing) + 1) * spacing
+    start = offsets[:, None] * n + pu.min() * u
+    end = offsets[:, None] * n + pu.max() * u
+
+    lines = np.stack([ start, end ], axis = 1)
+    lines[1::2] = lines[1::2, ::-1]
+
+    return list(lines)
+
+@register_pattern("lines", 1, 2)
+def lines_pattern(xmin, ymin, xmax, ymax, spacing, layer, z):
+    """ Parallel lines, crossing at 90° from one layer to the next """
+    return parallel_lines(xmin, ymin, xmax, ymax, spacing, math.pi / 4 if layer % 2 == 0 else -math.pi / 4)
+
+@register_pattern("grid", 2)
+def grid_pattern(xmin, ymin, xmax, ymax, spacing, layer, z):
+    """ Lines along X and Y on each layer """
+    return parallel_lines(xmin, ymin, xmax, ymax, spacing, 0) + parallel_lines(xmin, ymin, xmax, ymax, spacing, math.pi / 2)
+
+@register_pattern("triangles", 3)
+def triangles_pattern(xmin, ymin, xmax, ymax, spacing, layer, z):
+    """ Three families of lines at 60° from each other, crossing at the same points """
+    return sum([ parallel_lines(xmin, ymin, xmax, ymax, spacing, a) for a in (0, math.pi / 3, 2 * math.pi / 3) ], [])
+
+@register_pattern("honeycomb", 2 / math.sqrt(3))
+def honeycomb_pattern(xmin, ymin, xmax, ymax, spacing, layer, z):
+    """ Regular hexagons, 'spacing' being the length of their sides. Each row is printed as a series
+        of '^' shapes, the bottom sides of a row are the top sides of the previous one """
+
+    import numpy as np
+
+    side = spacing
+    h = side * math.sqrt(3) / 2
+
+    rows = np.arange(math.floor(ymin / h) - 1, math.ceil(ymax / h) + 1)
+    period = 3 * side
+    polylines = []
+
+    for k in rows:
+        # Each row is shifted by half a period from the previous one
+        shift = (k % 2) * 1.5 * side
+        x0 = np.arange(math.floor((xmin - shift) / period) - 1, math.ceil((xmax - shift) / period) + 1) * period + shift
+        y0 = k * h
+
+        shape = np.array([ [ 0, 0 ], [ side / 2, h ], [ 1.5 * side, h ], [ 2 * side, 0 ] ])
+        pts = shape[None, :, :] + np.stack([ x0, np.full_like(x0, y0) ], axis = 1)[:, None, :]
+
+        if k % 2 == 1:
+            pts = pts[::-1, ::-1]
+
+        polylines += list(pts)
+
+    return polylines
+
+@register_pattern("gyroid", 2.3, None)
+def gyroid_pattern(xmin, ymin, xmax, ymax, spacing, layer, z):
+    """ Section at height z of the gyroid surface sin(x)cos(y) + sin(y)cos(z) + sin(z)cos(x) = 0
+        with a period of 'spacing' """
+
+    import numpy as np
+
+    k = 2 * math.pi / spacing
+    sz, cz = math.sin(k * z), math.cos(k * z)
+
+    # Solve a.cos(v) + b.sin(v) = c along samples of u, with (u, v) = (x, y) when the curves run along X:
+    # sin(x)cos(y) + cos(z)sin(y) = -sin(z)cos(x), or (u, v) = (y, x) when they run along Y:
+    # sin(z)cos(x) + cos(y)sin(x) = -cos(z)sin(y)
+    along_x = abs(cz) >= abs(sz)
+
+    if along_x:
+        umin, umax, vmin, vmax = xmin, xmax, ymin, ymax
+    else:
+        umin, umax, vmin, vmax = ymin, ymax, xmin, xmax
+
+    u = np.arange(umin - spacing, umax + spacing, spacing / 16)
+
+    if along_x:
+        a, b, c = np.sin(k * u), np.full_like(u, cz), -sz * np.cos(k * u)
+    else:
+        a, b, c = np.full_like(u, sz), np.cos(k * u), -cz * np.sin(k * u)
+
+    r = np.hypot(a, b)
+    phi = np.arctan2(b, a)
+
+    with np.errstate(invalid = "ignore", divide = "ignore"):
+        delta = np.arccos(c / r)
+
+    polylines = []
+
+    for n in range(math.floor(vmin / spacing) - 1, math.ceil(vmax / spacing) + 1):
+        for sign in (1, -1):
+            v = (phi + sign * delta) / k + n * spacing
+            pts = np.stack([ u, v ] if along_x else [ v, u ], axis = 1)
+
+            # Split where there is no solution or the branch wraps around
+            jump = np.concatenate([ [ True ], np.abs(np.diff(v)) > spacing / 4 ]) | np.isnan(v)
+
+            for piece in np.split(pts, np.flatnonzero(jump)):
+                piece = piece[~np.isnan(piece).any(axis = 1)]
+                if len(piece) > 1:
+                    polylines.append(piece if len(polylines) % 2 == 0 else piece[::-1])
+
+    return polylines
+
+def clip_polylines(paths, polylines, chunk = 1000000):
+    """ Clips polylines against the polygons 'paths' (even-odd rule).
+        Returns the list of the polylines parts inside the polygons """
+
+    import numpy as np
+
+    if len(polylines) == 0 or len(paths) == 0:
+        return []
+
+    # Polygon edges, paths are closed if needed
+    edges = []
+    for path in paths:
+        pts = np.asarray(path, dtype = float)
+        if len(pts) > 1 and not np.array_equal(pts[0], pts[-1]):
+            pts = np.concatenate([ pts, pts[:1] ])
+        edges.append(np.concatenate([ pts[:-1], pts[1:] ], axis = 1))
+    edges = np.concatenate(edges)
+    a, f = edges[:, :2], edges[:, 2:] - edges[:, :2]
+
+    # Segments of the polylines, with the index of their polyline
+    segs = np.concatenate([ np.concatenate([ p[:-1], p[1:] ], axis = 1) for p in polylines ])
+    owner = np.repeat(np.arange(len(polylines)), [ len(p) - 1 for p in polylines ])
+
+    pieces = []
+    step = max(1, chunk // len(edges))
+
+    for i in range(0, len(segs), step):
+        s = segs[i:i + step]
+        p, d = s[:, None, :2], s[:, None, 2:] - s[:, None, :2]
+
+        # An edge crosses the line of a segment when its ends are on different sides
+        ap, bp = a[None] - p, a[None] + f[None] - p
+        side_a = d[..., 0] * ap[..., 1] - d[..., 1] * ap[..., 0] > 0
+        side_b = d[..., 0] * bp[..., 1] - d[..., 1] * bp[..., 0] > 0
+        cross = side_a != side_b
+
+        with np.errstate(invalid = "ignore", divide = "ignore"):
+            t = (ap[..., 0] * f[None, :, 1] - ap[..., 1] * f[None, :, 0]) / (d[..., 0] * f[None, :, 1] - d[..., 1] * f[None, :, 0])
+        t = np.where(cross, t, np.nan)
+
+        # Inside at the start of the segment if an odd number of edges are crossed before it
+        inside = np.count_nonzero(t <= 0, axis = 1) % 2 == 1
+
+        t = np.sort(np.where((t > 0) & (t < 1), t, np.nan), axis = 1)
+        bounds = np.concatenate([ np.zeros((len(s), 1)), np.nan_to_num(t, nan = 1.0), np.ones((len(s), 1)) ], axis = 1)
+
+        # Intervals between crossings are alternatively inside and outside
+        for j in range(bounds.shape[1] - 1):
+            t0, t1 = bounds[:, j], bounds[:, j + 1]
+            keep = (inside ^ (j % 2 == 1)) & (t1 - t0 > 1e-9)
+
+            idx = np.flatnonzero(keep)
+            q0 = s[idx, :2] + t0[idx, None] * (s[idx, 2:] - s[idx, :2])
+            q1 = s[idx, :2] + t1[idx, None] * (s[idx, 2:] - s[idx, :2])
+            pieces.append(np.column_stack([ idx + i, t0[idx], t1[idx], q0, q1 ]))
+
+    pieces = np.concatenate(pieces)
+    if len(pieces) == 0:
+        return []
+
+    pieces = pieces[np.lexsort((pieces[:, 1], pieces[:, 0]))]
+
+    # Join the pieces continuing each other along the same polyline
+    seg = pieces[:, 0].astype(np.int64)
+    cont = (owner[seg[1:]] == owner[seg[:-1]]) & (seg[1:] == seg[:-1] + 1) & \
+           (pieces[:-1, 2] > 1 - 1e-9) & (pieces[1:, 1] < 1e-9)
+
+    result = []
+    for group in np.split(np.arange(len(pieces)), np.flatnonzero(~cont) + 1):
+        pts = np.concatenate([ pieces[group[:1], 3:5], pieces[group, 5:7] ])
+        result.append(pts)
+
+    return result
+
+def infill(paths, xmin, ymin, xmax, ymax, pattern, density, width, layer, z):
+    """ Returns the infill polylines of a region for a pattern name and a density in [0, 1] """
+
+    if density <= 0:
+        return []
+
+    if pattern not in PATTERNS:
+        raise ValueError("unknown infill pattern " + pattern)
+
+    function, factor, _ = PATTERNS[pattern]
+    spacing = factor * width / min(density, 1.0)
+
+    return clip_polylines(paths, function(xmin, ymin, xmax, ymax, spacing, layer, z))
@@ -1,33 +1,137 @@
 #!/usr/bin/env python
 
-import os, math, sys
+import os, io, re, copy, math, sys, hashlib
+from collections import OrderedDict
 import numpy as np
 from timeit import default_timer as timer
 
-from fill import GridPattern
+from fill import GridPattern, infill, pattern_period
+from estimator import Estimator, is_report
+from util import fit_arcs2d
+from settings import SCHEMA, compile_schema, merge_configuration, model_setting
 
 class GCode:
     
-    def __init__(self, config):
+    def __init__(self, config, fd = None):
         self.config = config
-        self.fd = None
+        # Output stream, stdout if None
+        self.fd = fd
+
+        # Settings of each model, indexed by model name
+        self.profiles = dict()
+        self.setup(self.config)
+
+        # Moves of the current layer for the print time estimation, arrays of
+        # rows (x, y, z, extruded length, feedrate, extruding), starting with the current position
+        self.estimator = Estimator(config) if self.config["estimate"]["enabled"] else None
+        self.z = 0.0
+        self.moves = [ np.zeros((1, 6)) ]
+
+        # Active tool and extrusion length of each tool
+        self.tool = 0
+        self.e_tools = dict()
+
+        # List of commands
+        self.lineno = 1
+
+        # E values are relative to the previous move (M83) instead of absolute
+        self.relative = self.config["gcode"]["relative_extrusion"]
+
+        # Most recently rendered layers, reused for the layers with the same toolpaths
+        self.templates = OrderedDict()
+        self.templates_size = self.config["gcode"]["reuse_layers"]
+        self.reused = 0
+        self.e_trace = None
+
+    def setup(self, profile):
+        """ Uses the settings of 'profile' for the next commands """
+        self.profile = profile
                 
         # Convert speed from mm/s to mm/min
-        self.sp_travel = self.config["speed"]["travel"] * 60
-        self.sp_print = self.config["speed"]["print"] * 60
-        self.sp_infill = self.config["speed"]["infill"] * 60
+        self.sp_travel = profile["speed"]["travel"] * 60
+        self.sp_print = profile["speed"]["print"] * 60
+        self.sp_infill = profile["speed"]["infill"] * 60
         
         # Areas to compute extrusion length
-        self.nozzle_area = self.config["extruder"]["nozzle_diameter"] * self.config["extruder"]["nozzle_diameter"] * math.pi
-        self.filament_area = self.config["extruder"]["filament_diameter"] * self.config["extruder"]["filament_diameter"] * math.pi
+        self.nozzle_area = profile["extruder"]["nozzle_diameter"] * profile["extruder"]["nozzle_diameter"] * math.pi
+        self.filament_area = profile["extruder"]["filament_diameter"] * profile["extruder"]["filament_diameter"] * math.pi
 
-        # List of commands
-        self.lineno = 1
+        # Replace runs of points laying on a circle by G2/G3 moves
+        self.arc_fitting = profile["path"]["arc_fitting"]
+        self.arc_tolerance = profile["path"]["arc_tolerance"]
+
+    def model_profile(self, model):
+        """ Returns the settings of a model: the global ones, overridden by its tool extruder and its own settings """
+
+        if model.name in self.profiles:
+            return self.profiles[model.name]
+
+        models = self.config["models"]
+        overrides = models.get(model.name, models.get(os.path.basename(model.name), {}))
+        tool = overrides.get("tool", 0)
+
+        # The other settings are shared by all the models
+        ignored = [ path for path, v in compile_schema(overrides).items()
+                    if path in SCHEMA and not isinstance(v, dict) and not model_setting(path) ]
+        if len(ignored) > 0:
+            raise ValueError("{0}: {1} can't be set per model".format(model.name, ", ".join(ignored)))
+
+        if tool >= max(1, len(self.config["extruders"])):
+            raise ValueError("{0}: no extruder for tool #{1}".format(model.name, tool))
+
+        profile = copy.deepcopy(self.config)
+        if tool < len(self.config["extruders"]):
+            merge_configuration(profile["extruder"], self.config["extruders"][tool])
+        merge_configuration(profile, overrides)
+        profile["tool"] = tool
+
+        self.profiles[model.name] = profile
+
+        return profile
+
+    def tool_change(self, tool, length):
+        """ Selects another tool, returns the extrusion length of the new tool """
+
+        # Each tool has its own extrusion axis position
+        self.e_tools[self.tool] = length
+        self.tool = tool
+
+        length = self.e_tools.get(tool, 0)
+        self.emit("T{0}".format(tool))
+
+        # Relative extrusion doesn't depend on the position of the extrusion axis
+        if not self.relative:
+            self.emit("G92 E{0:.5f}".format(length))
+
+        return length
         
+    def e_value(self, e_len, length):
+        """ Returns the E value of a move extruding 'length', 'e_len' being the total length extruded so far """
+
+        if self.e_trace != None:
+            self.e_trace.append(e_len)
+
+        return length if self.relative else e_len
+
     def emit(self, text):
-        print(text)
+        print(text, file = self.fd)
         self.lineno = self.lineno + 1
         
+    def record(self, xy, extruded, feed, extruding):
+        """ Records the moves to the points of the (n, 2) array 'xy' for the estimation """
+
+        if self.estimator is None:
+            return
+
+        rows = np.empty((len(xy), 6))
+        rows[:, :2] = xy
+        rows[:, 2] = self.z
+        rows[:, 3] = extruded
+        rows[:, 4] = feed
+        rows[:, 5] = extruding
+
+        self.moves.append(rows)
+
     def extrusion_length(self, x0, y0, x1, y1):
         """ Returns the extrusion length to print from (x0, y0) to (x1, y1) """
 
@@ -46,45 +150,279 @@ class GCode:
         prev = [ None, None ]
 
         self.emit("G0 F{0} X{1:.5f} Y{2:.5f} Z{3:.5f}".format(self.sp_travel, path[0][0], path[0][1], z + float(self.config["quality"])))
-                  
-        e_len += self.extrusion_length(path[0][0], path[0][1], path[1][0], path[1][1])
-        self.emit("G1 F{0} X{1:.5f} Y{2:.5f} E{3:.5f}".format(self.sp_print, path[1][0], path[1][1], e_len))
-        
-        prev[0], prev[1] = path[1][0], path[1][1]
+
+        if self.estimator != None:
+            self.z = z + float(self.config["quality"])
+            pts = np.asarray(path, dtype = float)
+            lengths = np.hypot(*np.diff(pts, axis = 0).T) * self.nozzle_area / self.filament_area
+            self.record(pts[:1], 0, self.sp_travel, 0)
+            self.record(pts[1:], lengths, self.sp_print, 1)
+
+        if self.arc_fitting:
+            moves = fit_arcs2d(path, self.arc_tolerance)
+        else:
+            moves = [ (p[0], p[1], None) for p in path[1:] ]
+
+        # Feedrate is only set on the first move
+        feed = " F{0}".format(self.sp_print)
+        prev[0], prev[1] = path[0][0], path[0][1]
         
-        for p in path[2:]:
-            e_len += self.extrusion_length(prev[0], prev[1], p[0], p[1])            
-            self.emit("G1 X{0:.5f} Y{1:.5f} E{2:.5f}".format(p[0], p[1], e_len))
-            prev[0], prev[1] = p[0], p[1]
+        for x, y, arc in moves:
+            if arc is None:
+                l = self.extrusion_length(prev[0], prev[1], x, y)
+                e_len += l
+                self.emit("G1{0} X{1:.5f} Y{2:.5f} E{3:.5f}".format(feed, x, y, self.e_value(e_len, l)))
+            else:
+                i, j, clockwise, distance = arc
+                l = (self.nozzle_area * distance) / self.filament_area
+                e_len += l
+                self.emit("{0}{1} X{2:.5f} Y{3:.5f} I{4:.5f} J{5:.5f} E{6:.5f}".format("G2" if clockwise else "G3", feed, x, y, i, j,
+                                                                                      self.e_value(e_len, l)))
+
+            feed = ""
+            prev[0], prev[1] = x, y
 
         return e_len
 
-    def do_infill(self, paths, xmin, ymin, xmax, ymax, step, length):
+    def record_segments(self, segments):
+        """ Records the infill segments for the estimation: a travel to their start, then an extrusion """
+
+        if self.estimator is None or len(segments) == 0:
+            return
+
+        s = np.asarray(segments, dtype = float)
+        xy = s.reshape(-1, 2)
+        extruded = np.zeros(len(xy))
+        extruded[1::2] = np.hypot(s[:, 2] - s[:, 0], s[:, 3] - s[:, 1]) * self.nozzle_area / self.filament_area
+        extruding = np.tile([ 0, 1 ], len(s))
+
+        self.record(xy, extruded, self.sp_infill, extruding)
+
+    def do_infill(self, paths, xmin, ymin, xmax, ymax, layer_nr, z, length):
+        """ Emits the infill of a region with the pattern and density of the current profile """
         e_len = length
-        
-        grid = GridPattern(xmin, ymin, xmax, ymax, step) 
 
-        grid.scan(paths, GridPattern.BOTH_AXIS)
-        for s in grid.segments:
-            self.emit("G0 F{0} X{1:.5f} Y{2:.5f}".format(self.sp_infill, s[0], s[1]))
-            e_len += self.extrusion_length(s[0], s[1], s[2], s[3])
-            self.emit("G1 F{0} X{1:.5f} Y{2:.5f} E{3:.5f}".format(self.sp_infill, s[2], s[3], e_len))
+        polylines = infill(paths, xmin, ymin, xmax, ymax, self.profile["infill_pattern"], self.profile["filling_percent"] / 100.0,
+                           self.profile["extruder"]["nozzle_diameter"], layer_nr, z)
+
+        for pts in polylines:
+            self.emit("G0 F{0} X{1:.5f} Y{2:.5f}".format(self.sp_infill, pts[0][0], pts[0][1]))
+
+            lengths = np.hypot(*np.diff(pts, axis = 0).T) * self.nozzle_area / self.filament_area
+            feed = " F{0}".format(self.sp_infill)
+
+            for p, l in zip(pts[1:], lengths):
+                e_len += l
+                self.emit("G1{0} X{1:.5f} Y{2:.5f} E{3:.5f}".format(feed, p[0], p[1], self.e_value(e_len, l)))
+                feed = ""
+
+            if self.estimator != None:
+                self.record(pts[:1], 0, self.sp_infill, 0)
+                self.record(pts[1:], lengths, self.sp_infill, 1)
 
         return e_len
     
     def do_surface(self, paths, xmin, ymin, xmax, ymax, direction, length):
         e_len = length
         
-        grid = GridPattern(xmin, ymin, xmax, ymax, self.config["extruder"]["nozzle_diameter"]) 
+        grid = GridPattern(xmin, ymin, xmax, ymax, self.profile["extruder"]["nozzle_diameter"]) 
 
         grid.scan(paths, direction)
+        self.record_segments(grid.segments)
         for s in grid.segments:
             self.emit("G0 F{0} X{1:.5f} Y{2:.5f}".format(self.sp_infill, s[0], s[1]))
-            e_len += self.extrusion_length(s[0], s[1], s[2], s[3])
-            self.emit("G1 F{0} X{1:.5f} Y{2:.5f} E{3:.5f}".format(self.sp_infill, s[2], s[3], e_len))
+            l = self.extrusion_length(s[0], s[1], s[2], s[3])
+            e_len += l
+            self.emit("G1 F{0} X{1:.5f} Y{2:.5f} E{3:.5f}".format(self.sp_infill, s[2], s[3], self.e_value(e_len, l)))
 
         return e_len
     
+    def report(self):
+        """ Writes the estimation report, next to the G-code file unless a name is configured """
+
+        name = self.config["estimate"]["report"]
+
+        if name == None and self.config["output"] != None:
+            name = os.path.splitext(self.config["output"])[0] + ".estimate.json"
+
+        if name == None:
+            return
+
+        # Only a previous report may be replaced
+        if os.path.exists(name) and not is_report(name):
+            print("warning: " + name + " exists and is not an estimation report, not overwritten", file = sys.stderr)
+            return
+
+        self.estimator.write(name)
+
+    def begin(self):
+        """ Starts the G-code, before the first layer """
+
+        if self.relative:
+            self.emit("M83")
+
+    def layer_key(self, layer, layer_nr):
+        """ Returns a hash of the toolpaths of a layer, None if the layer can't be reused:
+            it changes the tool or its infill depends on the height """
+
+        h = hashlib.blake2b(digest_size = 16)
+
+        for xmin, ymin, xmax, ymax, paths, model in layer:
+            profile = self.model_profile(model)
+            period = pattern_period(profile["infill_pattern"])
+
+            if profile["tool"] != self.tool or period == None:
+                return None
+
+            h.update(repr((model.name, xmin, ymin, xmax, ymax, layer_nr % period, [ len(p) for p in paths ])).encode())
+            for path in paths:
+                h.update(np.asarray(path, dtype = float).tobytes())
+
+        return h.digest()
+
+    def render_layer(self, layer, layer_nr, z, e_len):
+        """ Emits a layer and returns it as a template: its text split around the Z values, and the E
+            values when they are absolute, with what is needed to replay it at another height """
+
+        fd, lineno, start = self.fd, self.lineno, self.moves[-1][-1]
+
+        # E values are traced to be stored as offsets from the extrusion length at the start of the layer
+        self.fd = io.StringIO()
+        self.e_trace = []
+        length = self.draw_layer(layer, layer_nr, z, e_len)
+        text = self.fd.getvalue()
+        self.fd = fd
+
+        print(text, end = "", file = self.fd)
+
+        parts = re.split(r"(Z)(-?\d+\.\d+)" if self.relative else r"([EZ])(-?\d+\.\d+)", text)
+        trace = iter(self.e_trace)
+        self.e_trace = None
+
+        template = { "texts": parts[0::3], "letters": parts[1::3],
+                     "values": [ next(trace) - e_len if l == "E" else 0 for l in parts[1::3] ],
+                     "length": length - e_len, "lines": self.lineno - lineno, "profile": self.profile,
+                     "moves": np.concatenate(self.moves[1:] + [ np.zeros((0, 6)) ]), "estimate": None }
+
+        self.moves = [ start[None] ]
+        self.estimate_layer(template, z)
+
+        return template, length
+
+    def estimate_layer(self, template, z):
+        """ Estimates the moves of a template played at height z """
+
+        if self.estimator is None:
+            return
+
+        moves = template["moves"].copy()
+        moves[:, 2] = z + float(self.config["quality"])
+        start = self.moves[-1][-1]
+
+        # The estimation only depends on the moves and on the previous position
+        key = (start[0], start[1], z + float(self.config["quality"]) - start[2])
+
+        if template["estimate"] != None and template["estimate"][0] == key:
+            self.estimator.repeat_layer(z, template["estimate"][1])
+        else:
+            self.estimator.add_layer(z, np.concatenate([ start[None], moves ]))
+            template["estimate"] = (key, self.estimator.layers[-1])
+
+        if len(moves) > 0:
+            self.moves = [ moves[-1:] ]
+
+    def replay_layer(self, template, z, e_len):
+        """ Emits a rendered layer at height z from the extrusion length 'e_len', returns the new extrusion length """
+
+        zs = "{0:.5f}".format(z + float(self.config["quality"]))
+        values = [ zs if l == "Z" else "{0:.5f}".format(e_len + v) for l, v in zip(template["letters"], template["values"]) ]
+
+        text = [ None ] * (len(template["texts"]) + 2 * len(values))
+        text[0::3], text[1::3], text[2::3] = template["texts"], template["letters"], values
+
+        print("".join(text), end = "", file = self.fd)
+        self.lineno += template["lines"]
+
+        if template["profile"] is not self.profile:
+            self.setup(template["profile"])
+
+        self.estimate_layer(template, z)
+
+        return e_len + template["length"]
+
+    def dump_layer(self, layer, layer_nr, z, e_len):
+        """ Emits a layer, a list of [ xmin, ymin, xmax, ymax, paths, model ] regions, returns the extrusion length """
+
+        self.emit("; layer #" + str(layer_nr))
+
+        key = self.layer_key(layer, layer_nr) if self.templates_size > 0 else None
+
+        if key == None:
+            e_len = self.draw_layer(layer, layer_nr, z, e_len)
+
+            if self.estimator != None:
+                moves = np.concatenate(self.moves)
+                self.estimator.add_layer(z, moves)
+                self.moves = [ moves[-1:] ]
+
+            return e_len
+
+        if key in self.templates:
+            self.templates.move_to_end(key)
+            self.reused += 1
+            return self.replay_layer(self.templates[key], z, e_len)
+
+        self.templates[key], e_len = self.render_layer(layer, layer_nr, z, e_len)
+
+        if len(self.templates) > self.templates_size:
+            self.templates.popitem(last = False)
+
+        return e_len
+
+    def draw_layer(self, layer, layer_nr, z, e_len):
+        """ Emits the toolpaths of a layer, returns the extrusion length """
+
+        # Group the regions by tool, starting with the active one, to minimize tool changes
+        regions = [ (self.model_profile(region[5]), region) for region in layer ]
+        tools = sorted(set(profile["tool"] for profile, _ in regions), key = lambda t: (t != self.tool, t))
+
+        for tool in tools:
+            if tool != self.tool:
+                e_len = self.tool_change(tool, e_len)
+
+            for profile, (xmin, ymin, xmax, ymax, paths, model) in regions:
+                if profile["tool"] != tool:
+                    continue
+
+                if profile is not self.profile:
+                    self.setup(profile)
+
+                # Coordinates are shifted by the offset of the extruder
+                ox, oy = profile["extruder"]["offset_x"], profile["extruder"]["offset_y"]
+                if ox != 0 or oy != 0:
+                    paths = [ [ (p[0] - ox, p[1] - oy) for p in path ] for path in paths ]
+                    xmin, ymin, xmax, ymax = xmin - ox, ymin - oy, xmax - ox, ymax - oy
+
+                # Perimeter
+                for path in paths:
+                    self.emit("; perimeter")
+                    e_len = self.do_path(path, z, e_len)
+
+                # Filling
+                self.emit("; infill")
+                #e_len = self.do_surface(paths, xmin, ymin, xmax, ymax, layer_nr % 2, e_len)
+                e_len = self.do_infill(paths, xmin, ymin, xmax, ymax, layer_nr, z, e_len)
+
+        return e_len
+
+    def finish(self, e_len):
+        """ Ends the G-code once all the layers are emitted """
+
+        self.e_tools[self.tool] = e_len
+
+        if self.estimator != None:
+            self.report()
+
     def dump(self, layers):
         
         if self.config["verbose"]:
@@ -101,26 +439,20 @@ class GCode:
 
         start = timer()        
 
-        for z in np.arange(0.0, z_max, z_incr):
-            layer = layers[layer_nr]
-            self.emit("; layer #" + str(layer_nr))
-            
-            for xmin, ymin, xmax, ymax, paths in layer:
-                # Perimeter
-                for path in paths:
-                    self.emit("; perimeter")
-                    e_len = self.do_path(path, z, e_len)
+        self.begin()
 
-                # Filling
-                self.emit("; infill")
-                #e_len = self.do_surface(paths, xmin, ymin, xmax, ymax, layer_nr % 2, e_len)
-                e_len = self.do_infill(paths, xmin, ymin, xmax, ymax, 1, e_len)
-                                        
+        for z in np.arange(0.0, z_max, z_incr):
+            e_len = self.dump_layer(layers[layer_nr], layer_nr, z, e_len)
             layer_nr += 1
 
         end = timer()
 
+        self.finish(e_len)
+
         if self.config["verbose"]:
-            print(" done in {0:3.2f}s, {1:.2f}mm extruded".format(end - start, e_len), file = sys.stderr)
+            print(" done in {0:3.2f}s, {1:.2f}mm extruded".format(end - start, sum(self.e_tools.values())), file = sys.stderr)
+            if self.templates_size > 0:
+                print(" {0} layers reused".format(self.reused), file = sys.stderr)
+            if self.estimator != None:
+                print(" estimated print time {0:.0f}s".format(self.estimator.report()["time"]), file = sys.stderr)
             sys.stderr.flush()
-            
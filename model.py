@@ -1,18 +1,139 @@
 #!/usr/bin/env python
 
-import sys, stl
+import sys, copy, math, stl
 import numpy as np
 
+def convex_hull2d(points):
+    """ Returns the convex hull of an array of 2d points, counter-clockwise """
+
+    pts = np.unique(points, axis = 0)
+
+    if len(pts) < 3:
+        return pts
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    # Andrew's monotone chain, points are already sorted by np.unique
+    lower, upper = [], []
+
+    for p in pts:
+        while len(lower) >= 2 and cross(lower[-2], lower[-1], p) <= 0:
+            lower.pop()
+        lower.append(p)
+
+    for p in pts[::-1]:
+        while len(upper) >= 2 and cross(upper[-2], upper[-1], p) <= 0:
+            upper.pop()
+        upper.append(p)
+
+    return np.array(lower[:-1] + upper[:-1])
+
+def label_components(n, u, w, odd = None):
+    """ Connected components of the graph of n nodes and edges (u, w), by hooking the roots of the
+        trees on the smaller one and pointer jumping. 'odd' tells which edges join nodes of opposite
+        parities. Returns the root of each node, the smallest node of its component, and the parity
+        of each node relative to its root """
+
+    parent = np.arange(n)
+    parity = np.zeros(n, dtype = bool)
+    odd = np.zeros(len(u), dtype = bool) if odd is None else odd
+
+    while True:
+        # Flatten the trees so that each node points to its root
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parity ^= parity[parent]
+            parent = grand
+
+        # Edges within a tree stay so, only the ones between two trees are kept
+        ru, rw = parent[u], parent[w]
+        cross = ru != rw
+
+        if not cross.any():
+            return parent, parity
+
+        u, w, odd = u[cross], w[cross], odd[cross]
+        ru, rw = ru[cross], rw[cross]
+
+        # Hook the larger root on the smaller one, once per root
+        hi, first = np.unique(np.maximum(ru, rw), return_index = True)
+        parent[hi] = np.minimum(ru, rw)[first]
+        parity[hi] = (parity[u] ^ parity[w] ^ odd)[first]
+
+def weld(v, tolerance):
+    """ Merges the points of v closer than 'tolerance' (transitively). Returns the merged points
+        and the index of each point of v in them """
+
+    # Identical points first
+    order = np.lexsort(v.T[::-1])
+    v = v[order]
+    new = np.concatenate([ [ True ], (v[1:] != v[:-1]).any(axis = 1) ])
+    points = v[new]
+    inverse = np.empty(len(v), dtype = np.int64)
+    inverse[order] = np.cumsum(new) - 1
+
+    # Close points are in the same cell of a grid or near the common side of neighbouring cells.
+    # Cells are twice as large as the tolerance, to bound the number of candidates in a cell and
+    # of the points near a side. Cells are hashed, collisions only add candidates
+    size = 2 * tolerance
+    cells = np.floor(points / size).astype(np.int64)
+    cell_hash = lambda c: c[:, 0] * 73856093 ^ c[:, 1] * 19349663 ^ c[:, 2] * 83492791
+
+    frac = points / size - cells
+    near = { -1: frac * size <= tolerance, 1: (1 - frac) * size <= tolerance }
+
+    h = cell_hash(cells)
+    order = np.argsort(h, kind = "stable")
+    h = h[order]
+
+    # Points of the same cell: each one with the next ones of its group
+    end = np.searchsorted(h, h, side = "right")
+    count = end - np.arange(len(h)) - 1
+    k = np.repeat(np.arange(len(h)), count)
+    u = [ order[k] ]
+    w = [ order[k + 1 + np.arange(len(k)) - np.repeat(np.cumsum(count) - count, count)] ]
+
+    # Points near a side, with the cells beyond it. Half of the neighbours are enough, the other
+    # half is seen from the other side
+    for d in [ (dx, dy, dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1) if (dx, dy, dz) > (0, 0, 0) ]:
+        need = np.ones(len(points), dtype = bool)
+        for axis, step in enumerate(d):
+            if step != 0:
+                need &= near[step][:, axis]
+
+        i = np.flatnonzero(need)
+        target = cell_hash(cells[i] + d)
+        lo = np.searchsorted(h, target, side = "left")
+        count = np.searchsorted(h, target, side = "right") - lo
+
+        u.append(np.repeat(i, count))
+        w.append(order[np.repeat(lo - np.cumsum(count) + count, count) + np.arange(count.sum())])
+
+    u, w = np.concatenate(u), np.concatenate(w)
+    close = (u != w) & (np.linalg.norm(points[u] - points[w], axis = 1) <= tolerance)
+
+    root, _ = label_components(len(points), u[close], w[close])
+    roots, merged = np.unique(root, return_inverse = True)
+
+    return points[roots], merged.reshape(-1)[inverse]
+
 class Model:
         
-    def __init__(self, name):
-        """ Constructor, load data from file """
+    def __init__(self, name, config = None):
+        """ Constructor, load data from file and repair the mesh if the configuration asks to """
         self.name = name
 
         if self.name.lower().endswith(".stl"):
             self.mesh = stl.mesh.Mesh.from_file(self.name)
         else:
             raise ValueError("unknown model file format")
+
+        self.repaired = None
+        if config != None and config["repair"]["enabled"]:
+            self.repaired = self.repair(config["repair"]["tolerance"])
         
         # models bounds
         self.bbox_min = [ None, None, None ]
@@ -20,48 +141,184 @@ class Model:
         self.update_bounds()
 
         self.intersect = [] # facets that intersect the slicing plan
+        self.zindex = None  # facets listed by z bucket, built on demand
+
+        # Height of the z buckets, a layer by default
+        self.z_step = float(config["quality"]) if config != None else None
+
+    def copy(self):
+        """ Returns an independent copy of the model, the mesh data is duplicated """
+        clone = copy.copy(self)
+        clone.mesh = stl.mesh.Mesh(self.mesh.data.copy())
+        clone.bbox_min = list(self.bbox_min)
+        clone.bbox_max = list(self.bbox_max)
+        clone.intersect = []
+
+        # The z index is read only, shared until the clone moves along Z
+        clone.zindex = self.zindex
+
+        return clone
+
+    def repair(self, tolerance):
+        """ Welds the vertices closer than 'tolerance', removes degenerated and duplicated facets
+            and orients the facets consistently, outwards. Returns a dict of statistics """
+
+        v = self.mesh.vectors.reshape(-1, 3).astype(np.float64)
+
+        # Weld the vertices closer than the tolerance
+        verts, inverse = weld(v, tolerance)
+        faces = inverse.reshape(-1, 3)
+
+        # Degenerated facets: two identical vertices or no area
+        p0, p1, p2 = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+        area = np.linalg.norm(np.cross(p1 - p0, p2 - p0), axis = 1)
+        ok = (faces[:, 0] != faces[:, 1]) & (faces[:, 1] != faces[:, 2]) & (faces[:, 0] != faces[:, 2]) & (area > tolerance * tolerance)
+        degenerated = int(np.count_nonzero(~ok))
+        faces = faces[ok]
+
+        # Duplicated facets, whatever their orientation, keep the first one
+        key = np.sort(faces, axis = 1)
+        order = np.lexsort(key.T[::-1])
+        key = key[order]
+        first = order[np.concatenate([ [ True ], (key[1:] != key[:-1]).any(axis = 1) ])]
+        duplicated = len(faces) - len(first)
+        faces = faces[np.sort(first)]
+
+        flipped = self.orient(verts, faces)
+
+        data = np.zeros(len(faces), dtype = stl.mesh.Mesh.dtype)
+        data["vectors"] = verts[faces]
+        self.mesh = stl.mesh.Mesh(data)
+        self.mesh.update_normals()
+
+        return { "vertices": len(verts), "degenerated": degenerated, "duplicated": duplicated, "flipped": flipped }
+
+    def orient(self, verts, faces):
+        """ Flips the facets (in place) so that adjacent facets share their edges in opposite directions
+            and each connected part has a positive volume. Returns the number of flipped facets """
+
+        n = len(faces)
+
+        if n == 0:
+            return 0
+
+        # Directed edges a -> b of each facet, and their undirected key
+        a = faces.reshape(-1)
+        b = np.roll(faces, -1, axis = 1).reshape(-1)
+        owner = np.repeat(np.arange(n), 3)
+        forward = a < b
+        key = np.where(forward, a, b) * len(verts) + np.where(forward, b, a)
+
+        # Edges shared by exactly two facets
+        order = np.argsort(key, kind = "stable")
+        key, owner, forward = key[order], owner[order], forward[order]
+        pair = np.flatnonzero(key[1:] == key[:-1])
+        pair = pair[((pair + 2 >= len(key)) | (key[np.minimum(pair + 2, len(key) - 1)] != key[pair])) &
+                    ((pair == 0) | (key[pair - 1] != key[pair]))]
+
+        f0, f1 = owner[pair], owner[pair + 1]
+        # Both facets run along the edge in the same direction, one of them has to be flipped
+        same = forward[pair] == forward[pair + 1]
+
+        # Propagate the orientation over each connected part, 'part' being the first facet of the part
+        part, flip = label_components(n, f0, f1, same)
+
+        # Signed volume of each part, parts with a negative volume are inside out
+        p0, p1, p2 = verts[faces[:, 0]], verts[faces[:, 1]], verts[faces[:, 2]]
+        volume = np.einsum("ij,ij->i", p0, np.cross(p1, p2)) * np.where(flip, -1, 1)
+        flip ^= np.bincount(part, weights = volume, minlength = n)[part] < 0
+
+        faces[flip, 1], faces[flip, 2] = faces[flip, 2], faces[flip, 1].copy()
+
+        return int(np.count_nonzero(flip))
+
+    def size(self):
+        """ Returns the memory footprint of the mesh in bytes """
+        return self.mesh.data.nbytes
 
     def translate(self, tx, ty, tz):
         """ Translate the mesh """
-        items = [ [0, 3, 6],  # x
-                  [1, 4, 7],  # y
-                  [2, 5, 8] ] # z
-
-        for p in self.mesh.points:
-            for i in range(3):
-                if tx != 0:
-                    p[items[0][i]] += tx
-                if ty != 0:
-                    p[items[1][i]] += ty
-                if tz != 0:
-                    p[items[2][i]] += tz
 
         if tx != 0 or ty != 0 or tz != 0:
+            self.mesh.vectors += [ tx, ty, tz ]
             self.update_bounds()
-            
+
+        # The z index only depends on the heights of the facets
+        if tz != 0:
+            self.zindex = None
+
+    def rotate(self, angle):
+        """ Rotate the mesh around the Z axis going through the center of its bounding box, angle in radians """
+
+        if angle == 0:
+            return
+
+        c, s = math.cos(angle), math.sin(angle)
+        cx = (self.bbox_min[0] + self.bbox_max[0]) / 2
+        cy = (self.bbox_min[1] + self.bbox_max[1]) / 2
+
+        x, y = self.mesh.vectors[:, :, 0] - cx, self.mesh.vectors[:, :, 1] - cy
+        self.mesh.vectors[:, :, 0], self.mesh.vectors[:, :, 1] = cx + c * x - s * y, cy + s * x + c * y
+
+        nx, ny = self.mesh.normals[:, 0].copy(), self.mesh.normals[:, 1].copy()
+        self.mesh.normals[:, 0], self.mesh.normals[:, 1] = c * nx - s * ny, s * nx + c * ny
+
+        self.update_bounds()
+
+    def footprint(self):
+        """ Returns the convex hull of the projection of the mesh on the XY plane, counter-clockwise """
+        return convex_hull2d(self.mesh.vectors[:, :, :2].reshape(-1, 2))
+
     def update_bounds(self):
         """ Computes model bounds """
 
-        self.bbox_min[0] = self.bbox_min[1] = self.bbox_min[2] = 99999.0
-        self.bbox_max[0] = self.bbox_max[1] = self.bbox_max[2] = -1.0
-        
-        for p in self.mesh.points:
-            # p contains (x, y, z)
-            self.bbox_max[0] = max(p[stl.Dimension.X], self.bbox_max[0])
-            self.bbox_min[0] = min(p[stl.Dimension.X], self.bbox_min[0])
-            self.bbox_max[1] = max(p[stl.Dimension.Y], self.bbox_max[1])
-            self.bbox_min[1] = min(p[stl.Dimension.Y], self.bbox_min[1])
-            self.bbox_max[2] = max(p[stl.Dimension.Z], self.bbox_max[2])
-            self.bbox_min[2] = min(p[stl.Dimension.Z], self.bbox_min[2])
+        pts = self.mesh.vectors.reshape(-1, 3)
+
+        self.bbox_min = [ float(v) for v in pts.min(axis = 0) ]
+        self.bbox_max = [ float(v) for v in pts.max(axis = 0) ]
+
+    def build_zindex(self):
+        """ Dispatches the facets into z buckets: each bucket lists, in the mesh order, the facets
+            crossing its height range so that only a few candidates are tested for a plan """
+
+        z = self.mesh.vectors[:, :, 2]
+        zmin, zmax = z.min(axis = 1), z.max(axis = 1)
+
+        if len(z) == 0:
+            self.zindex = (0.0, 1.0, np.zeros(1, dtype = np.int64), np.zeros(0, dtype = np.int64), zmin, zmax)
+            return
+
+        lo = float(zmin.min())
+        step = self.z_step if self.z_step != None else max(float(zmax.max()) - lo, 1.0) / 1024
+
+        first = np.floor((zmin - lo) / step).astype(np.int64)
+        last = np.floor((zmax - lo) / step).astype(np.int64)
+
+        # One entry per facet and bucket it crosses, grouped by bucket
+        span = last - first + 1
+        facets = np.repeat(np.arange(len(z)), span)
+        buckets = np.repeat(first, span) + np.arange(len(facets)) - np.repeat(np.cumsum(span) - span, span)
+
+        order = np.argsort(buckets, kind = "stable")
+        starts = np.concatenate([ [ 0 ], np.cumsum(np.bincount(buckets, minlength = int(last.max()) + 1)) ])
+
+        # (lowest z, bucket height, first entry of each bucket, facets by bucket, zmin, zmax)
+        self.zindex = (lo, step, starts, facets[order], zmin, zmax)
         
     def set_slicing_plan(self, z):
         """ Compute internal list of facets that intersect w/ the slicing plan """
 
-        del self.intersect[:]
-        
-        for p in self.mesh.points:
-            zmin = min(p[2], min(p[5], p[8]))
-            zmax = max(p[2], max(p[5], p[8]))
+        if self.zindex is None:
+            self.build_zindex()
+
+        lo, step, starts, facets, zmin, zmax = self.zindex
+
+        b = int(np.floor((z - lo) / step))
+
+        if b < 0 or b >= len(starts) - 1:
+            self.intersect = []
+            return
 
-            if zmin <= z and zmax >= z:
-                self.intersect.append(p)
+        # Candidates are the facets of the bucket, in the mesh order
+        c = facets[starts[b]:starts[b + 1]]
+        self.intersect = list(self.mesh.points[c[(zmin[c] <= z) & (zmax[c] >= z)]])
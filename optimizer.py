@@ -4,7 +4,7 @@ import math, sys
 import numpy as np
 from timeit import default_timer as timer
 
-from util import fequals, colinear2d
+from util import fequals, colinear2d, simplify2d
 
 class Optimizer:
     """ """
@@ -71,10 +71,68 @@ class Optimizer:
 
             if len(path) > 1:
                 paths.append(path)
-            else:
-                print("path of length == 1")
+            elif self.config["verbose"]:
+                print("path of length == 1", file = sys.stderr)
+
+        distance = self.config["repair"]["close_gaps"]
+
+        if distance > 0:
+            paths = self.close_gaps(paths, distance)
 
         return paths
+
+    def close_gaps(self, paths, distance):
+        """ Connects the open paths whose endpoints are closer than 'distance', and closes
+            the paths whose own endpoints are that close """
+
+        def is_open(path):
+            return not fequals(path[0][0], path[-1][0]) or not fequals(path[0][1], path[-1][1])
+
+        closed = [ p for p in paths if not is_open(p) ]
+        pending = [ p for p in paths if is_open(p) ]
+        done = []
+
+        while len(pending) > 0:
+            path = pending.pop(0)
+            extended = False
+
+            # Try to extend the end of the path, then its start
+            for attempt in range(2):
+                # Endpoints of the candidates: own start, then starts and ends of the other open paths
+                ends = np.array([ path[0] ] + [ p[0] for p in pending ] + [ p[-1] for p in pending ])
+                d = np.hypot(ends[:, 0] - path[-1][0], ends[:, 1] - path[-1][1])
+                k = int(np.argmin(d))
+
+                if d[k] <= distance:
+                    extended = True
+                    if k == 0:
+                        path.append(path[0])
+                        closed.append(path)
+                    else:
+                        n = len(pending)
+                        other = pending.pop((k - 1) % n)
+                        other = other if k <= n else other[::-1]
+                        # Skip the first point of the other path if both paths touch
+                        path.extend(other[1:] if fequals(d[k], 0) else other)
+                        pending.insert(0, path)
+                    break
+
+                path.reverse()
+
+            if not extended:
+                done.append(path)
+
+        return closed + done
+
+    def simplify(self, paths):
+        """ Drops the points of each path that deviate less than the configured chord tolerance """
+
+        tolerance = self.config["path"]["tolerance"]
+
+        if tolerance <= 0:
+            return paths
+
+        return [ simplify2d(path, tolerance) for path in paths ]
         
     def optimize(self, layers):
         """ At this point, the layers are a list of unordered segments.
@@ -91,8 +149,10 @@ class Optimizer:
         ini_sz = 0
         # Number of points in the final slicing plan
         new_sz = 0
-        # Optimized layers
-        optimized = []
+        # Number of points before and after simplification
+        pts_sz, smp_sz = 0, 0
+        # Optimized layers, in the same kind of container as the input ones
+        optimized = layers.spawn() if hasattr(layers, "spawn") else []
 
         cnt = 0
         
@@ -102,7 +162,7 @@ class Optimizer:
 
             paths = []
 
-            for xmin, ymin, xmax, ymax, segs in slice:            
+            for xmin, ymin, xmax, ymax, segs, model in slice:            
                 if self.config["verbose"]:
                     print(" {:3.2f}%".format(cnt / len(layers) * 100.0), end = "", file = sys.stderr)
                     print("\b\b\b\b\b\b\b\b", end = "", file = sys.stderr)
@@ -112,7 +172,11 @@ class Optimizer:
                 plist = self.points_from_segments(segs)            
                 new_sz += len(plist)
 
-                paths.append([ xmin, ymin, xmax, ymax, plist ])
+                pts_sz += sum(len(p) for p in plist)
+                plist = self.simplify(plist)
+                smp_sz += sum(len(p) for p in plist)
+
+                paths.append([ xmin, ymin, xmax, ymax, plist, model ])
 
             optimized.append(paths)
             
@@ -126,6 +190,7 @@ class Optimizer:
                                                                                       (new_sz * 100 / ini_sz) - 100,
                                                                                       end - start),
                   file = sys.stderr)
+            print(" {0} points simplified to {1}".format(pts_sz, smp_sz), file = sys.stderr)
             sys.stderr.flush()
 
         return optimized
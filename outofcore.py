@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import os, io, sys, math, pickle, tempfile
+import numpy as np
+
+from model import convex_hull2d
+
+# Binary STL record: normal, 3 vertices and attributes
+STL_DTYPE = np.dtype([ ("normal", "<f4", (3, )), ("vectors", "<f4", (9, )), ("attr", "<u2") ])
+
+# Bytes needed to process a facet: record, float copies and indexes
+FACET_COST = 256
+
+class MappedModel:
+    """ A model whose facets stay on disk. The facets are dispatched into z-buckets files,
+        each one small enough to fit the memory budget, and sliced one bucket at a time """
+
+    def __init__(self, name, config):
+        """ Constructor, maps the binary STL file """
+        self.name = name
+        self.config = config
+
+        if not self.name.lower().endswith(".stl"):
+            raise ValueError("unknown model file format")
+
+        with open(self.name, "rb") as f:
+            f.seek(80)
+            count = int(np.frombuffer(f.read(4), dtype = "<u4")[0])
+
+        if os.path.getsize(self.name) != 84 + count * STL_DTYPE.itemsize:
+            raise ValueError("out-of-core mode requires a binary STL file")
+
+        self.facets = np.memmap(self.name, dtype = STL_DTYPE, mode = "r", offset = 84, shape = (count, ))
+
+        # Facets processed at once
+        self.chunk = max(1024, self.config["outofcore"]["memory"] * 1024 * 1024 // FACET_COST)
+
+        # Transformation applied while reading the facets: x' = m.(x, y) + (tx, ty), z' = z + tz
+        self.matrix = np.identity(2)
+        self.offset = np.zeros(3)
+
+        # models bounds
+        self.bbox_min = [ None, None, None ]
+        self.bbox_max = [ None, None, None ]
+        self.update_bounds()
+
+        self.intersect = [] # facets that intersect the slicing plan
+        self.repaired = None # mapped meshes are not repaired
+
+        if self.config["repair"]["enabled"]:
+            print("warning: {0}: meshes are not repaired in out-of-core mode".format(self.name), file = sys.stderr)
+
+        self.workdir = None
+        self.buckets = None  # layer index -> bucket index
+        self.sizes = None    # number of facets of each bucket
+        self.current = None  # (bucket index, facets, zindex) of the loaded bucket
+
+    def chunks(self):
+        """ Iterates over the transformed facets as (n, 9) float arrays """
+
+        for start in range(0, len(self.facets), self.chunk):
+            v = np.array(self.facets["vectors"][start:start + self.chunk], dtype = np.float64).reshape(-1, 3, 3)
+
+            xy = v[:, :, :2] @ self.matrix.T
+            v[:, :, 0] = xy[:, :, 0] + self.offset[0]
+            v[:, :, 1] = xy[:, :, 1] + self.offset[1]
+            v[:, :, 2] += self.offset[2]
+
+            yield v.reshape(-1, 9)
+
+    def translate(self, tx, ty, tz):
+        """ Translate the mesh """
+
+        if tx != 0 or ty != 0 or tz != 0:
+            self.offset += [ tx, ty, tz ]
+
+            # Bounds are shifted, no need to read the facets again
+            self.bbox_min = [ v + t for v, t in zip(self.bbox_min, (tx, ty, tz)) ]
+            self.bbox_max = [ v + t for v, t in zip(self.bbox_max, (tx, ty, tz)) ]
+            self.buckets = None
+            self.current = None
+
+    def rotate(self, angle):
+        """ Rotate the mesh around the Z axis going through the center of its bounding box, angle in radians """
+
+        if angle == 0:
+            return
+
+        c, s = math.cos(angle), math.sin(angle)
+        r = np.array([ [ c, -s ], [ s, c ] ])
+        center = np.array([ (self.bbox_min[0] + self.bbox_max[0]) / 2, (self.bbox_min[1] + self.bbox_max[1]) / 2 ])
+
+        self.matrix = r @ self.matrix
+        self.offset[:2] = r @ (self.offset[:2] - center) + center
+
+        # A quarter turn around the center swaps the extents of the bounding box
+        if math.isclose(math.remainder(angle, math.pi / 2), 0, abs_tol = 1e-12):
+            quarters = int(round(angle / (math.pi / 2)))
+            w, h = self.bbox_max[0] - self.bbox_min[0], self.bbox_max[1] - self.bbox_min[1]
+            if quarters % 2 == 1:
+                w, h = h, w
+            self.bbox_min[:2] = [ center[0] - w / 2, center[1] - h / 2 ]
+            self.bbox_max[:2] = [ center[0] + w / 2, center[1] + h / 2 ]
+            self.buckets = None
+            self.current = None
+        else:
+            self.update_bounds()
+
+    def footprint(self):
+        """ Returns the convex hull of the projection of the mesh on the XY plane """
+
+        hull = np.zeros((0, 2))
+
+        for v in self.chunks():
+            pts = np.concatenate([ hull, v.reshape(-1, 3)[:, :2] ])
+            hull = convex_hull2d(pts)
+
+        return hull
+
+    def update_bounds(self):
+        """ Computes model bounds """
+
+        lo, hi = np.full(3, np.inf), np.full(3, -np.inf)
+
+        for v in self.chunks():
+            pts = v.reshape(-1, 3)
+            lo = np.minimum(lo, pts.min(axis = 0))
+            hi = np.maximum(hi, pts.max(axis = 0))
+
+        self.bbox_min = [ float(x) for x in lo ]
+        self.bbox_max = [ float(x) for x in hi ]
+
+        # Buckets have to be rebuilt
+        self.buckets = None
+        self.current = None
+
+    def layer_range(self, v, z_incr):
+        """ Returns the indexes of the first and last layers crossing each facet """
+
+        z = v[:, 2::3]
+        first = np.ceil(z.min(axis = 1) / z_incr - 1e-6).astype(np.int64)
+        last = np.floor(z.max(axis = 1) / z_incr + 1e-6).astype(np.int64)
+
+        return np.maximum(first, 0), last
+
+    def build_buckets(self):
+        """ Dispatches the facets into z-buckets files fitting the memory budget """
+
+        z_incr = float(self.config["quality"])
+        count = max(1, int(math.floor(self.bbox_max[2] / z_incr + 1e-6)) + 1)
+
+        # First pass: number of facets starting at each layer and crossing each layer
+        starts = np.zeros(count, dtype = np.int64)
+        diff = np.zeros(count + 1, dtype = np.int64)
+
+        for v in self.chunks():
+            first, last = self.layer_range(v, z_incr)
+            ok = first <= last
+            first, last = first[ok], np.minimum(last[ok], count - 1)
+
+            s = np.bincount(first, minlength = count + 1)
+            starts += s[:count]
+            diff += s - np.bincount(last + 1, minlength = count + 1)
+
+        crossing = np.cumsum(diff)[:count]
+
+        # Group successive layers while the facets of the group fit the budget. The size of a bucket
+        # is its actual number of facets, a layer crossing more facets than the budget is a bucket
+        capacity = self.chunk
+        self.buckets = np.zeros(count, dtype = np.int64)
+        self.sizes = [ int(crossing[0]) ]
+
+        for l in range(1, count):
+            if self.sizes[-1] + starts[l] > capacity:
+                self.sizes.append(int(crossing[l]))
+            else:
+                self.sizes[-1] += int(starts[l])
+            self.buckets[l] = len(self.sizes) - 1
+
+        b = len(self.sizes) - 1
+
+        if max(self.sizes) > capacity:
+            print("warning: {0}: a layer crosses {1} facets, {2} MB over outofcore.memory".format(self.name, max(self.sizes),
+                  int(math.ceil((max(self.sizes) - capacity) * FACET_COST / (1024 * 1024)))), file = sys.stderr)
+
+        # Second pass: write each facet in all the buckets it crosses
+        self.workdir = tempfile.TemporaryDirectory(prefix = "abbot-", dir = self.config["outofcore"]["directory"])
+        files = [ open(self.bucket_name(i), "wb") for i in range(b + 1) ]
+
+        try:
+            for v in self.chunks():
+                first, last = self.layer_range(v, z_incr)
+                ok = (first <= last) & (first < count)
+                v, b0, b1 = v[ok], self.buckets[first[ok]], self.buckets[np.minimum(last[ok], count - 1)]
+
+                for i in range(b0.min(initial = b + 1), b1.max(initial = -1) + 1):
+                    files[i].write(v[(b0 <= i) & (b1 >= i)].astype(np.float32).tobytes())
+        finally:
+            for f in files:
+                f.close()
+
+    def bucket_name(self, i):
+        return os.path.join(self.workdir.name, "bucket{0}.bin".format(i))
+
+    def set_slicing_plan(self, z):
+        """ Compute internal list of facets that intersect w/ the slicing plan """
+
+        if self.buckets is None:
+            self.build_buckets()
+
+        l = int(round(z / float(self.config["quality"])))
+
+        if l < 0 or l >= len(self.buckets):
+            self.intersect = []
+            return
+
+        # Only one bucket is mapped at a time
+        b = self.buckets[l]
+
+        if self.current is None or self.current[0] != b:
+            self.current = None
+            name = self.bucket_name(b)
+            if os.path.getsize(name) > 0:
+                facets = np.memmap(name, dtype = np.float32, mode = "r").reshape(-1, 9)
+            else:
+                facets = np.zeros((0, 9), dtype = np.float32)
+            zmin = facets[:, 2::3].min(axis = 1)
+            order = np.argsort(zmin, kind = "stable")
+            self.current = (b, facets, order, zmin[order], facets[:, 2::3].max(axis = 1)[order])
+
+        _, facets, order, zmin, zmax = self.current
+
+        n = np.searchsorted(zmin, z, side = "right")
+        self.intersect = list(facets[np.sort(order[:n][zmax[:n] >= z])])
+
+class LayerStore:
+    """ A list of layers spilled to disk. Layers are pickled in a file as they are appended
+        and read back on access, the models they refer to are stored as references """
+
+    def __init__(self, config, models):
+        self.config = config
+        self.models = models
+
+        self.fd = tempfile.TemporaryFile(prefix = "abbot-", dir = self.config["outofcore"]["directory"])
+        self.offsets = []
+
+    def spawn(self):
+        """ Returns a new empty store for the same models """
+        return LayerStore(self.config, self.models)
+
+    def append(self, layer):
+        self.fd.seek(0, io.SEEK_END)
+        self.offsets.append(self.fd.tell())
+
+        pickler = pickle.Pickler(self.fd, protocol = pickle.HIGHEST_PROTOCOL)
+        ids = { id(m): i for i, m in enumerate(self.models) }
+        pickler.persistent_id = lambda obj: ids.get(id(obj))
+        pickler.dump(layer)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, i):
+        self.fd.seek(self.offsets[i])
+
+        unpickler = pickle.Unpickler(self.fd)
+        unpickler.persistent_load = lambda pid: self.models[pid]
+
+        return unpickler.load()
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
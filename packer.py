@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
-import sys
+import sys, math
+import numpy as np
 from model import Model
 
 class Rectangle:
@@ -16,70 +17,156 @@ class Rectangle:
         self.w = w
         self.h = h
 
+def min_area_angle(hull):
+    """ Returns the rotation angle that minimizes the area of the bounding box of a convex hull (rotating calipers) """
+
+    if len(hull) < 3:
+        return 0
+
+    edges = np.roll(hull, -1, axis = 0) - hull
+    angles = np.unique(np.mod(np.arctan2(edges[:, 1], edges[:, 0]), math.pi / 2))
+
+    # Rotate the hull by -angle for each candidate to align the edge with the X axis
+    c, s = np.cos(angles), np.sin(angles)
+    x = np.outer(c, hull[:, 0]) + np.outer(s, hull[:, 1])
+    y = np.outer(-s, hull[:, 0]) + np.outer(c, hull[:, 1])
+    areas = (x.max(axis = 1) - x.min(axis = 1)) * (y.max(axis = 1) - y.min(axis = 1))
+
+    return -float(angles[np.argmin(areas)])
+
 class Packer:
-    """ A class which packs models on a surface """
+    """ A class which packs models on a surface using the maximal rectangles algorithm """
 
     def __init__(self, config):
         """ Initialize the surface """
 
         self.config = config
-        
+
         # Dimensions of the printer plate
         self.xmax = self.config["printer"]["max"][0]
         self.ymax = self.config["printer"]["max"][1]
 
+        # Space between two models
+        self.gap = self.config["packer"]["gap"]
+        # Allow 90° rotations of the models
+        self.rotate = self.config["packer"]["rotate"]
+        # Orient the models to minimize the bounding box of their footprint
+        self.hull = self.config["packer"]["hull"]
+
         # List of models to pack
         self.models = []
         # List of busy places
         self.places = []
-        
+        # Models area / plate area, and models area / used area
+        self.density = 0
+        self.used_density = 0
+
     def add(self, model):
         self.models.append(model)
 
+    def place(self, free, w, h):
+        """ Finds the best free rectangle for a w x h item (best short side fit).
+            Returns (index, rotated) or None if the item doesn't fit """
+
+        best = None
+
+        for rotated, (iw, ih) in enumerate([ (w, h), (h, w) ]):
+            if rotated and (not self.rotate or w == h):
+                break
+
+            dw, dh = free[:, 2] - iw, free[:, 3] - ih
+            fits = (dw >= 0) & (dh >= 0)
+
+            if not fits.any():
+                continue
+
+            short = np.where(fits, np.minimum(dw, dh), np.inf)
+            long_side = np.where(fits, np.maximum(dw, dh), np.inf)
+            i = int(np.lexsort((long_side, short))[0])
+
+            if best == None or (short[i], long_side[i]) < best[0]:
+                best = ((short[i], long_side[i]), i, bool(rotated))
+
+        return None if best == None else best[1:]
+
+    def split(self, free, x, y, w, h):
+        """ Removes the rectangle (x, y, w, h) from the free rectangles and returns the maximal ones left """
+
+        fx, fy, fw, fh = free[:, 0], free[:, 1], free[:, 2], free[:, 3]
+        hit = (x < fx + fw) & (x + w > fx) & (y < fy + fh) & (y + h > fy)
+
+        keep = free[~hit]
+        f = free[hit]
+        fx, fy, fw, fh = f[:, 0], f[:, 1], f[:, 2], f[:, 3]
+
+        # Up to four new free rectangles around the busy one: left, right, bottom, top
+        parts = np.concatenate([
+            np.stack([ fx, fy, x - fx, fh ], axis = 1),
+            np.stack([ np.full_like(fx, x + w), fy, fx + fw - (x + w), fh ], axis = 1),
+            np.stack([ fx, fy, fw, y - fy ], axis = 1),
+            np.stack([ fx, np.full_like(fy, y + h), fw, fy + fh - (y + h) ], axis = 1) ])
+        parts = parts[(parts[:, 2] > 0) & (parts[:, 3] > 0)]
+
+        free = np.unique(np.concatenate([ keep, parts ]), axis = 0)
+
+        # Drop the free rectangles contained in another one
+        a, b = free[:, None, :], free[None, :, :]
+        inside = (a[..., 0] >= b[..., 0]) & (a[..., 1] >= b[..., 1]) & \
+                 (a[..., 0] + a[..., 2] <= b[..., 0] + b[..., 2]) & (a[..., 1] + a[..., 3] <= b[..., 1] + b[..., 3])
+        np.fill_diagonal(inside, False)
+
+        return free[~inside.any(axis = 1)]
+
     def arrange(self):
+        if len(self.models) == 0:
+            return True
+
+        if self.hull:
+            for m in self.models:
+                m.rotate(min_area_angle(m.footprint()))
+
         # Reverse sort the rectangles according their longest dimension
         self.models.sort(reverse = True, key = lambda m: max(m.bbox_max[0] - m.bbox_min[0], m.bbox_max[1] - m.bbox_min[1]))
 
-        a_width, a_height = 0, 0
-        gap = 10
-        
+        # Each model is inflated by the gap, so does the plate to allow models on its borders
+        free = np.array([ [ 0.0, 0.0, self.xmax + self.gap, self.ymax + self.gap ] ])
+        del self.places[:]
+        area = 0
+
         for m in self.models:
-            
+
             m_width = m.bbox_max[0] - m.bbox_min[0]
             m_height = m.bbox_max[1] - m.bbox_min[1]
 
-            # If the plate is empty, just try to put the first model
-            if len(self.places) == 0:
-                if m_width <= self.xmax and m_height <= self.ymax:
-                    self.places.append( Rectangle(0, 0, m_width, m_height) )
-                    a_width = m_width
-                    a_height = m_height
-                    continue
-                else:
-                    print("Model doesn't fit on the plate", file = sys.stderr)
-                    return False
-
-            if a_width <= a_height and a_width + m_width <= self.xmax:
-                self.places.append( Rectangle(gap + self.places[-1].x + self.places[-1].w, self.places[-1].y, m_width, m_height) )
-                a_width += m_width + gap
-            elif a_height <= a_width and a_height + m_height <= self.ymax:
-                self.places.append( Rectangle(self.places[-1].x, gap + self.places[-1].y + self.places[-1].h, m_width, m_height) )
-                a_height += m_height + gap
-            else:
+            found = self.place(free, m_width + self.gap, m_height + self.gap)
+
+            if found == None:
                 print("Model doesn't fit on the plate", file = sys.stderr)
                 return False
 
+            i, rotated = found
+
+            if rotated:
+                m.rotate(math.pi / 2)
+                m_width, m_height = m_height, m_width
+
+            self.places.append( Rectangle(free[i][0], free[i][1], m_width, m_height) )
+            free = self.split(free, free[i][0], free[i][1], m_width + self.gap, m_height + self.gap)
+            area += m_width * m_height
 
         assert(len(self.models) == len(self.places))
-        
+
+        a_width = max(r.x + r.w for r in self.places)
+        a_height = max(r.y + r.h for r in self.places)
+
+        self.density = area / (self.xmax * self.ymax)
+        self.used_density = area / (a_width * a_height)
+
         # Finally, center the whole busy area on the plate
         tx = (self.xmax - a_width) / 2
         ty = (self.ymax - a_height) / 2
 
         for m, r in zip(self.models, self.places):
-            tz = -m.bbox_min[2]
-            m.translate(tx + r.x + r.w / 2, ty + r.y + r.h / 2, tz)
-              
+            m.translate(tx + r.x - m.bbox_min[0], ty + r.y - m.bbox_min[1], -m.bbox_min[2])
+
         return True
-            
-            
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+
+import io, os, sys, asyncio
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from timeit import default_timer as timer
+
+import numpy as np
+
+from slicer import Slicer
+from optimizer import Optimizer
+from gcode import GCode
+from settings import complete_configuration
+
+# Marks the end of the layers in a queue
+END = None
+
+# Slicer and optimizer of a worker process, set by init_worker
+worker = None
+
+def init_worker(config, models):
+    """ Worker initializer, the arranged models are inherited from the parent process """
+    global worker
+    worker = (Slicer(config, models), Optimizer(config))
+
+def slice_chunk(heights):
+    """ Slices and chains the layers at 'heights' in a worker. Models are returned as their index """
+
+    slicer, optimizer = worker
+    index = { id(m): i for i, m in enumerate(slicer.models) }
+
+    return [ [ [ xmin, ymin, xmax, ymax, optimizer.simplify(optimizer.points_from_segments(segs)), index[id(model)] ]
+               for xmin, ymin, xmax, ymax, segs, model in slicer.slice_layer(z) ] for z in heights ]
+
+class Pipeline:
+    """ Pipelined slicing: the models are loaded concurrently and arranged, then the layers are
+        sliced and chained by chunks in a pool of processes while the G-code of the previous ones
+        is rendered and written. The stages are connected by bounded queues, a stage waits when
+        the next one lags behind so only a few layers are in memory at once.
+
+        Slicing and chaining use all the CPUs. The G-code is rendered in order by a single thread
+        (the extrusion length runs through the layers) and written by another one, the event loop
+        only moves the layers from a stage to the next one. """
+
+    def __init__(self, config):
+        self.config = config
+
+        # Layers waiting between two stages
+        self.queue_size = self.config["pipeline"]["queue"]
+        self.workers = self.config["pipeline"]["workers"] or os.cpu_count()
+
+        # Busy time of each stage
+        self.busy = dict()
+
+    async def run_stage(self, name, executor, function, *args):
+        """ Runs 'function' in an executor, accounts its time to the stage 'name' """
+
+        start = timer()
+        result = await asyncio.get_running_loop().run_in_executor(executor, function, *args)
+        self.busy[name] = self.busy.get(name, 0) + timer() - start
+
+        return result
+
+    async def load(self, filenames):
+        """ Loads the models concurrently """
+
+        from model import Model
+        from outofcore import MappedModel
+
+        def load_model(name):
+            try:
+                if self.config["outofcore"]["enabled"]:
+                    return MappedModel(name, self.config)
+                return Model(name, self.config)
+            except Exception as err:
+                raise ValueError("Loading " + name + ": " + str(err))
+
+        return await asyncio.gather(*[ self.run_stage("load", self.threads, load_model, f) for f in filenames ])
+
+    async def slice(self, heights, output):
+        """ Submits the layers to the workers by chunks, the queue holds the pending chunks """
+
+        loop = asyncio.get_running_loop()
+
+        # Enough chunks to keep the workers busy, small enough to bound the memory
+        chunk = max(1, min(16, len(heights) // (self.workers * 8)))
+
+        for i in range(0, len(heights), chunk):
+            await output.put((i, loop.run_in_executor(self.processes, slice_chunk, heights[i:i + chunk])))
+
+        await output.put(END)
+
+    async def format(self, gcode, models, heights, input, output):
+        """ Renders the G-code of each layer, infill included, as a text block """
+
+        e_len = 0
+
+        def format_layer(layer_nr, layer, e_len):
+            gcode.fd = io.StringIO()
+            if layer_nr == 0:
+                gcode.begin()
+            layer = [ region[:5] + [ models[region[5]] ] for region in layer ]
+            e_len = gcode.dump_layer(layer, layer_nr, heights[layer_nr], e_len)
+            return gcode.fd.getvalue(), e_len
+
+        while True:
+            item = await input.get()
+            if item == END:
+                break
+
+            first, future = item
+
+            start = timer()
+            layers = await future
+            self.busy["slice"] = self.busy.get("slice", 0) + timer() - start
+
+            for i, layer in enumerate(layers):
+                text, e_len = await self.run_stage("format", self.formatter, format_layer, first + i, layer, e_len)
+                await output.put(text)
+
+        await output.put(END)
+
+        gcode.finish(e_len)
+
+    async def write(self, fd, input):
+        """ Writes the text blocks to the output """
+
+        while True:
+            text = await input.get()
+            if text == END:
+                break
+
+            await self.run_stage("write", self.threads, fd.write, text)
+
+        await self.run_stage("write", self.threads, fd.flush)
+
+    async def process(self, filenames, fd):
+        """ Slices the models of 'filenames' and writes the G-code to 'fd' """
+
+        verbose = self.config["verbose"]
+
+        with ThreadPoolExecutor(max_workers = max(2, len(filenames))) as self.threads, \
+             ThreadPoolExecutor(max_workers = 1) as self.formatter:
+            start = timer()
+
+            models = await self.load(filenames)
+
+            slicer = Slicer(self.config, models)
+            slicer.arrange()
+
+            # The z buckets of mapped models are built once, before the workers inherit them
+            for m in models:
+                if hasattr(m, "build_buckets") and m.buckets is None:
+                    m.build_buckets()
+
+            heights = np.arange(0, slicer.z_max(), float(self.config["quality"]))
+            gcode = GCode(self.config, fd)
+
+            with ProcessPoolExecutor(self.workers, initializer = init_worker, initargs = (self.config, models)) as self.processes:
+                chunks = asyncio.Queue(2 * self.workers)
+                formatted = asyncio.Queue(self.queue_size)
+
+                await asyncio.gather(self.slice(heights, chunks),
+                                     self.format(gcode, models, heights, chunks, formatted),
+                                     self.write(fd, formatted))
+
+        if verbose:
+            print("Pipeline done in {0:.2f}s with {1} workers".format(timer() - start, self.workers), file = sys.stderr)
+            print(" load: {0:.2f}s busy".format(self.busy.get("load", 0)), file = sys.stderr)
+            print(" slice: {0:.2f}s waited".format(self.busy.get("slice", 0)), file = sys.stderr)
+            for name in [ "format", "write" ]:
+                print(" {0}: {1:.2f}s busy".format(name, self.busy.get(name, 0)), file = sys.stderr)
+            if gcode.templates_size > 0:
+                print(" {0} layers reused".format(gcode.reused), file = sys.stderr)
+            if gcode.estimator != None:
+                print(" estimated print time {0:.0f}s".format(gcode.estimator.report()["time"]), file = sys.stderr)
+
+def run_pipeline(config, filenames, fd = None):
+    """ Slices the models of 'filenames' with the pipelined executor, writes the G-code to 'fd',
+        to the output file or stdout if None """
+
+    complete_configuration(config)
+
+    if fd == None and config.get("output") != None:
+        with open(config["output"], "w") as f:
+            run_pipeline(config, filenames, f)
+        return
+
+    asyncio.run(Pipeline(config).process(filenames, fd if fd != None else sys.stdout))
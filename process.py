@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+
+from slicer import Slicer
+from optimizer import Optimizer
+from gcode import GCode
+from settings import complete_configuration
+
+def process(config, models, fd = None):
+    """ Slices the models and writes the G-code to 'fd', to the output file or stdout if None """
+
+    complete_configuration(config)
+
+    if fd == None and config.get("output") != None:
+        with open(config["output"], "w") as f:
+            process(config, models, f)
+        return
+
+    slicer = Slicer(config, models)
+    slices = slicer.build_slicing_plan()
+
+    optimizer = Optimizer(config)
+    layers = optimizer.optimize(slices)
+
+    gcode = GCode(config, fd)
+    gcode.dump(layers)
@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+
+import os, sys, copy, io, json, threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer
+from timeit import default_timer as timer
+
+from model import Model
+from process import process
+from settings import merge_configuration, validate_configuration
+
+# Settings naming files on the server, clients may not override them
+PATH_SETTINGS = [ "output", "estimate.report", "outofcore.directory" ]
+
+def path_overrides(overrides):
+    """ Returns the path settings set by the overrides of a job """
+
+    found = []
+
+    for path in PATH_SETTINGS:
+        node = overrides
+        for k in path.split("."):
+            node = node.get(k) if isinstance(node, dict) else None
+        if node != None:
+            found.append(path)
+
+    return found
+
+class ModelCache:
+    """ A memory bounded LRU cache of loaded models """
+
+    def __init__(self, config, capacity):
+        """ Constructor, capacity is expressed in bytes """
+        self.config = config
+        self.capacity = capacity
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.models = OrderedDict() # key -> Model
+        self.lock = threading.Lock()
+
+    def key(self, name):
+        """ Cache key of a file, a modified file is reloaded """
+        st = os.stat(name)
+        return (os.path.abspath(name), st.st_mtime_ns, st.st_size)
+
+    def get(self, name):
+        """ Returns a private copy of the model loaded from 'name' """
+        key = self.key(name)
+
+        with self.lock:
+            model = self.models.get(key)
+            if model != None:
+                self.models.move_to_end(key)
+                self.hits += 1
+                return model.copy()
+
+        # Load outside of the lock, concurrent loads of the same file are harmless
+        model = Model(name, self.config)
+
+        # Cached models lay on the bed, the arrangement only moves them along X and Y
+        # and their copies share the z index
+        model.translate(0, 0, -model.bbox_min[2])
+        model.build_zindex()
+
+        with self.lock:
+            self.misses += 1
+
+            if key not in self.models and model.size() <= self.capacity:
+                self.models[key] = model
+                self.size += model.size()
+
+                # Evict least recently used models
+                while self.size > self.capacity:
+                    _, old = self.models.popitem(last = False)
+                    self.size -= old.size()
+
+        return model.copy()
+
+    def stats(self):
+        with self.lock:
+            return { "models": len(self.models), "size": self.size, "capacity": self.capacity,
+                     "hits": self.hits, "misses": self.misses }
+
+# Model cache of a worker process, set by init_worker
+cache = None
+
+def init_worker(config):
+    """ Worker initializer, each worker process has its own model cache """
+    global cache
+    cache = ModelCache(config, config["server"]["cache_size"] * 1024 * 1024)
+
+def run_job(config, filenames):
+    """ Slices a job in a worker process. Returns the G-code, the worker pid and its cache statistics """
+
+    models = [ cache.get(f) for f in filenames ]
+
+    fd = io.StringIO()
+    process(config, models, fd)
+
+    return fd.getvalue(), os.getpid(), cache.stats()
+
+class SliceHandler(BaseHTTPRequestHandler):
+    """ HTTP interface of the slicing server
+
+        GET  /status  returns the statistics of the worker caches
+        POST /slice   slices a job { "models": [ "file.stl", ... ], "config": { overrides } }
+                      without the settings naming files (PATH_SETTINGS)
+                      and sends the G-code back """
+
+    protocol_version = "HTTP/1.0"
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        if self.server.config["verbose"]:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def reply(self, code, obj):
+        body = json.dumps(obj).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/status":
+            self.reply(200, self.server.stats())
+        else:
+            self.reply(404, { "error": "unknown path " + self.path })
+
+    def do_POST(self):
+        if self.path != "/slice":
+            self.reply(404, { "error": "unknown path " + self.path })
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            job = json.loads(self.rfile.read(length))
+            filenames = job["models"]
+            overrides = job.get("config", {})
+            assert(isinstance(filenames, list) and len(filenames) > 0)
+            assert isinstance(overrides, dict), "config must be an object"
+        except Exception as err:
+            self.reply(400, { "error": "invalid job: " + str(err) })
+            return
+
+        forbidden = path_overrides(overrides)
+        if len(forbidden) > 0:
+            self.reply(400, { "error": "invalid job: " + ", ".join(forbidden) + " can't be set by a client" })
+            return
+
+        config, errors = self.server.job_configuration(overrides, filenames)
+        if len(errors) > 0:
+            self.reply(400, { "error": "invalid configuration", "errors": errors })
+            return
+
+        start = timer()
+
+        try:
+            text, pid, stats = self.server.pool.submit(run_job, config, filenames).result()
+        except Exception as err:
+            self.reply(500, { "error": str(err) })
+            return
+
+        self.server.update_stats(pid, stats)
+
+        body = text.encode("ascii")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/x-gcode")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        if self.server.config["verbose"]:
+            print("Sliced {0} in {1:.2f}s".format(", ".join(filenames), timer() - start), file = sys.stderr)
+
+class SliceServer:
+    """ Shared state of the slicing server: base configuration and worker pool.
+
+        Jobs run in a pool of processes, one job at a time per process, so that several jobs
+        slice on several CPUs. Each worker keeps its own model cache, the workers are started
+        by a fork server and don't inherit the threads of the HTTP server """
+
+    def __init__(self, config):
+        self.config = config
+        self.pool = ProcessPoolExecutor(config["server"]["workers"], mp_context = get_context("forkserver"),
+                                        initializer = init_worker, initargs = (config,))
+
+        # Cache statistics of each worker after its last job, by pid
+        self.workers = dict()
+        self.lock = threading.Lock()
+
+    def job_configuration(self, overrides, filenames):
+        """ Returns the configuration of a job and the list of its errors """
+
+        config = copy.deepcopy(self.config)
+        merge_configuration(config, overrides)
+
+        errors, _ = validate_configuration(config)
+        if len(errors) > 0:
+            return config, errors
+
+        config["verbose"] = False
+        config["filenames"] = filenames
+
+        # The G-code is sent back, nothing is written on the server
+        config["output"] = None
+        config["estimate"]["enabled"] = False
+
+        return config, errors
+
+    def update_stats(self, pid, stats):
+        with self.lock:
+            self.workers[pid] = stats
+
+    def stats(self):
+        """ Returns the statistics of the worker caches summed, the capacity is the one of a worker """
+
+        with self.lock:
+            total = { "workers": len(self.workers), "models": 0, "size": 0,
+                      "capacity": self.config["server"]["cache_size"] * 1024 * 1024, "hits": 0, "misses": 0 }
+
+            for stats in self.workers.values():
+                for k in [ "models", "size", "hits", "misses" ]:
+                    total[k] += stats[k]
+
+        return total
+
+class TCPSliceServer(SliceServer, ThreadingHTTPServer):
+
+    def __init__(self, config, address):
+        SliceServer.__init__(self, config)
+        ThreadingHTTPServer.__init__(self, address, SliceHandler)
+
+class UnixSliceServer(SliceServer, ThreadingMixIn, UnixStreamServer):
+
+    daemon_threads = True
+
+    def __init__(self, config, path):
+        SliceServer.__init__(self, config)
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        UnixStreamServer.__init__(self, path, SliceHandler)
+
+def serve(config, address):
+    """ Runs the slicing server until interrupted. 'address' is either host:port or a Unix socket path """
+
+    if ":" in address:
+        host, port = address.rsplit(":", 1)
+        server = TCPSliceServer(config, (host, int(port)))
+    else:
+        server = UnixSliceServer(config, address)
+
+    if config["verbose"]:
+        print("Serving on " + address, file = sys.stderr)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.shutdown()
@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+import os, copy, json
+
+# Configuration handling. The defaults and the schema derived from them are built once
+# when the module is imported, this module must stay light: no numpy here.
+
+def build_defaults(config):
+    """ Fills 'config' with the default settings """
+
+    # Basic default configuration
+    # Distance are expressed in mm and speeds in mm/s
+
+    config["verbose"] = False
+    config["output"] = None
+
+    # Printer
+    config["printer"] = dict()
+    config["printer"]["gcode"] = "marlin"
+    config["printer"]["min"] = [ 0, 0, 0 ]
+    config["printer"]["max"] = [ 200, 200, 200 ]
+    
+    # Extruder(s)
+    config["extruder"] = dict()        
+    config["extruder"]["nozzle_diameter"] = 0.35
+    config["extruder"]["filament_diameter"] = 1.75 
+    config["extruder"]["temperature"] = 200
+    config["extruder"]["offset_x"] = 0
+    config["extruder"]["offset_y"] = 0
+    config["extruder"]["fan_speed"] = 255
+    config["extruder"]["retract"] = dict()
+    config["extruder"]["retract"]["speed"] = 110
+    config["extruder"]["retract"]["distance"] = 4
+    
+    # Layer height
+    config["quality"] = 0.2
+    
+    # Speeds
+    config["speed"] = dict()
+    config["speed"]["print"] = 40
+    config["speed"]["travel"] = 150
+    config["speed"]["first_layer"] = 30
+    config["speed"]["outer_perimeter"] = 30
+    config["speed"]["inner_perimeter"] = 40
+    config["speed"]["infill"] = 60
+    config["speed"]["skin_infill"] = 30
+    
+    # Infill
+    config["filling_percent"] = 20    
+    config["infill_pattern"] = "grid" # a pattern of fill.py: grid, lines, triangles, honeycomb, gyroid
+
+    # Thickness
+    config["thickness"] = dict()
+    config["thickness"]["shell"] = 0.7
+    config["thickness"]["top_bottom"] = 0.6
+
+    # Settings of each extruder: extruders[i] overrides "extruder" for tool #i, starting with tool #0,
+    # e.g. [ {}, { "offset_x": 20 } ] for two heads. Empty for a single tool
+    config["extruders"] = []
+
+    # Per model settings, indexed by model file name, e.g. { "part.stl": { "tool": 1, "speed": { "print": 30 } } }
+    # Only the settings of MODEL_SETTINGS can be set per model
+    config["models"] = dict()
+
+    # Slicing server
+    config["server"] = dict()
+    config["server"]["workers"] = 4 # concurrent jobs, one process each
+    config["server"]["cache_size"] = 512 # MB, per worker
+
+    # Batch mode
+    config["batch"] = dict()
+    config["batch"]["workers"] = 0 # 0 means one per CPU
+
+    # Models arrangement on the plate
+    config["packer"] = dict()
+    config["packer"]["gap"] = 10
+    config["packer"]["rotate"] = True
+    config["packer"]["hull"] = False
+
+    # Layers kept in memory for previews
+    config["preview"] = dict()
+    config["preview"]["cache_layers"] = 64
+
+    # Out-of-core slicing of large meshes
+    config["outofcore"] = dict()
+    config["outofcore"]["enabled"] = False
+    config["outofcore"]["memory"] = 256 # MB
+    config["outofcore"]["directory"] = None # system temporary directory
+
+    # Mesh repair at load time
+    config["repair"] = dict()
+    config["repair"]["enabled"] = True
+    config["repair"]["tolerance"] = 0.00001 # vertices welding distance
+    config["repair"]["close_gaps"] = 0.0 # max distance between the endpoints of open paths to connect
+
+    # Motion settings for the print time estimation, in mm/s² and mm/s
+    config["motion"] = dict()
+    config["motion"]["acceleration"] = 1000
+    config["motion"]["travel_acceleration"] = 1500
+    config["motion"]["jerk"] = 10
+
+    # Print time and filament estimation, the report is written next to the G-code file by default
+    # (file.gcode -> file.estimate.json)
+    config["estimate"] = dict()
+    config["estimate"]["enabled"] = True
+    config["estimate"]["report"] = None
+
+    # Path simplification
+    config["path"] = dict()
+    config["path"]["tolerance"] = 0.01
+    config["path"]["arc_fitting"] = False
+    config["path"]["arc_tolerance"] = 0.025
+
+    # G-code output
+    config["gcode"] = dict()
+    config["gcode"]["relative_extrusion"] = False # M83
+    config["gcode"]["reuse_layers"] = 0 # rendered layers kept to be reused by identical layers, 0 disables
+
+    # Pipelined execution, the stages work on successive layers at the same time
+    config["pipeline"] = dict()
+    config["pipeline"]["enabled"] = False
+    config["pipeline"]["queue"] = 8 # layers waiting to be written
+    config["pipeline"]["workers"] = 0 # slicing processes, 0 means one per CPU
+
+# Default configuration and its schema, dotted path -> default value
+DEFAULTS = dict()
+build_defaults(DEFAULTS)
+
+def compile_schema(defaults, prefix = ""):
+    schema = dict()
+
+    for k, v in defaults.items():
+        schema[prefix + k] = v
+        if isinstance(v, dict) and len(v) > 0:
+            schema.update(compile_schema(v, prefix + k + "."))
+
+    return schema
+
+SCHEMA = compile_schema(DEFAULTS)
+
+# Settings that must be strictly positive
+POSITIVE = [ "quality", "extruder.nozzle_diameter", "extruder.filament_diameter", "speed.print", "speed.travel",
+             "speed.infill", "motion.acceleration", "motion.travel_acceleration", "repair.tolerance",
+             "pipeline.queue" ]
+
+# Settings a model can override, the other ones apply to the whole plate: the models share the
+# layers, and the paths of a layer are chained and simplified together
+MODEL_SETTINGS = [ "tool", "extruder", "speed", "filling_percent", "infill_pattern", "path.arc_fitting", "path.arc_tolerance" ]
+
+def model_setting(path):
+    """ Returns True if the setting 'path' can be overridden by a model """
+    return any(path == p or path.startswith(p + ".") for p in MODEL_SETTINGS)
+
+# Settings restricted to a set of values, registered by the modules defining them
+# (e.g. infill patterns in fill.py)
+CHOICES = dict()
+
+def register_choice(path, value):
+    """ Adds 'value' to the values allowed for the setting 'path' """
+
+    if value not in CHOICES.setdefault(path, []):
+        CHOICES[path].append(value)
+
+def init_configuration(config):
+    """ Fills 'config' with a copy of the default settings """
+    config.update(copy.deepcopy(DEFAULTS))
+
+def complete_configuration(config, defaults = DEFAULTS):
+    """ Adds the default value of the settings missing from 'config', e.g. in a configuration
+        written for an older version """
+
+    for k, v in defaults.items():
+        if k not in config:
+            config[k] = copy.deepcopy(v)
+        elif isinstance(v, dict) and isinstance(config[k], dict):
+            complete_configuration(config[k], v)
+
+def merge_configuration(config, overrides):
+    """ Recursively overrides the values of 'config' with the ones of 'overrides' """
+
+    for k, v in overrides.items():
+        if isinstance(v, dict) and isinstance(config.get(k), dict):
+            merge_configuration(config[k], v)
+        else:
+            config[k] = v
+
+def check_value(path, default, value):
+    """ Returns an error message if 'value' doesn't have the type of 'default', None otherwise """
+
+    if default is None:
+        ok = value is None or isinstance(value, str)
+    elif isinstance(default, bool):
+        ok = isinstance(value, bool)
+    elif isinstance(default, (int, float)):
+        ok = isinstance(value, (int, float)) and not isinstance(value, bool)
+    elif isinstance(default, list) and len(default) > 0:
+        ok = isinstance(value, list) and len(value) == len(default) and \
+             all(check_value(path, d, v) == None for d, v in zip(default, value))
+    else:
+        ok = isinstance(value, type(default))
+
+    if not ok:
+        return "{0}: invalid value {1}".format(path, json.dumps(value))
+
+    if path in POSITIVE and value <= 0:
+        return "{0}: must be positive".format(path)
+
+    if path in CHOICES and value not in CHOICES[path]:
+        return "{0}: must be one of {1}".format(path, ", ".join(CHOICES[path]))
+
+    return None
+
+def validate_configuration(config, prefix = "", partial = False):
+    """ Checks the settings against the schema. Returns (errors, warnings) as lists of messages.
+        In partial mode, settings may be missing (overrides) """
+
+    errors, warnings = [], []
+
+    if not partial:
+        for path in SCHEMA:
+            if path.startswith(prefix) and "." not in path[len(prefix):] and path[len(prefix):] not in config:
+                errors.append(path + ": missing")
+
+    for k, v in config.items():
+        path = prefix + k
+
+        if path not in SCHEMA:
+            # Runtime settings
+            if path in [ "filenames", "tool" ]:
+                continue
+            warnings.append(path + ": unknown setting")
+            continue
+
+        err = check_value(path, SCHEMA[path], v)
+
+        if err != None:
+            errors.append(err)
+        elif isinstance(v, dict) and len(SCHEMA[path]) > 0:
+            e, w = validate_configuration(v, path + ".", partial)
+            errors += e
+            warnings += w
+
+    # Overrides of the extruders and of the models
+    if prefix == "":
+        for i, extruder in enumerate(config.get("extruders", [])):
+            if not isinstance(extruder, dict):
+                errors.append("extruders[{0}]: invalid value".format(i))
+                continue
+            e, w = validate_configuration(extruder, "extruder.", True)
+            errors += [ "extruders[{0}] {1}".format(i, m) for m in e ]
+            warnings += [ "extruders[{0}] {1}".format(i, m) for m in w ]
+
+        for name, settings in config.get("models", {}).items():
+            if not isinstance(settings, dict):
+                errors.append("models[{0}]: invalid value".format(name))
+                continue
+            if not isinstance(settings.get("tool", 0), int) or settings.get("tool", 0) >= max(1, len(config.get("extruders", []))):
+                errors.append("models[{0}] tool: invalid value".format(name))
+            e, w = validate_configuration(settings, "", True)
+            e += [ path + ": can't be set per model" for path, v in compile_schema(settings).items()
+                   if path in SCHEMA and not isinstance(v, dict) and not model_setting(path) ]
+            errors += [ "models[{0}] {1}".format(name, m) for m in e ]
+            warnings += [ "models[{0}] {1}".format(name, m) for m in w ]
+
+    return errors, warnings
+
+def check_model(name):
+    """ Checks the header of a model file without loading it. Returns a description, raises ValueError """
+
+    if not name.lower().endswith(".stl"):
+        raise ValueError("unknown model file format")
+
+    size = os.path.getsize(name)
+
+    with open(name, "rb") as f:
+        head = f.read(84)
+
+    if size >= 84:
+        count = int.from_bytes(head[80:84], "little")
+        if size == 84 + count * 50:
+            return "binary STL, {0} facets".format(count)
+
+    if head.lstrip().startswith(b"solid"):
+        return "ascii STL"
+
+    raise ValueError("corrupted STL file, size doesn't match the number of facets")
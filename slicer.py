@@ -3,10 +3,14 @@
 import sys
 import numpy as np
 import stl
+from collections import OrderedDict
 from timeit import default_timer as timer
 
 from packer import Packer
 from model import Model
+from outofcore import LayerStore
+from optimizer import Optimizer
+from fill import infill
 from util import fequals, intercept2d
 
 class Slicer:
@@ -39,7 +43,10 @@ class Slicer:
         end = timer()
 
         if self.config["verbose"]:
-            print(" done ({0:.2}s)".format(end - start), file = sys.stderr)
+            print(" done ({0:.2}s), density {1:.1f}% of the plate, {2:.1f}% of the used area".format(end - start,
+                                                                                                  packer.density * 100,
+                                                                                                  packer.used_density * 100),
+                  file = sys.stderr)
 
     def slice_facet(self, facet, z):
         """ Slice a facet at height z """
@@ -105,6 +112,48 @@ class Slicer:
                     
         return n, p[0][0], p[0][1], p[1][0], p[1][1]
     
+    def slice_layer(self, z):
+        """ Slices all the models at height z, returns a list of [ xmin, ymin, xmax, ymax, segments, model ] """
+
+        slice = []
+
+        for m in self.models:
+            m.set_slicing_plan(z)
+
+            segs = []
+
+            xmin, ymin = 99999.0, 99999.0
+            xmax, ymax = 0.0, 0.0
+
+            for facet in m.intersect:
+                (n, xa, ya, xb, yb) = self.slice_facet(facet, z)
+
+                if n == 2:
+                    if not fequals(xa, xb) or not fequals(ya, yb):
+                        xmin = min(xmin, min(xa, xb))
+                        ymin = min(ymin, min(ya, yb))
+                        xmax = max(xmax, max(xa, xb))
+                        ymax = max(ymax, max(ya, yb))
+                        segs.append((xa, ya, xb, yb))
+                else:
+                    continue
+
+            if len(segs) > 0:
+                slice.append([ xmin, ymin, xmax, ymax, segs, m ])
+
+        return slice
+
+    def z_max(self):
+        """ Maximal Z slicing value """
+
+        z_max = 0.0
+
+        for m in self.models:
+            if z_max < m.bbox_max[2]:
+                z_max = m.bbox_max[2]
+
+        return z_max
+
     def build_slicing_plan(self):
         """ Slices the whole scene, returns a list of layers. Each slice is a list of unorganized segments """
 
@@ -116,55 +165,29 @@ class Slicer:
         self.arrange()
 
         # Maximal Z slicing value 
-        z_max = 0.0
-        
-        for m in self.models:
-            if z_max < m.bbox_max[2]:
-                z_max = m.bbox_max[2]
+        z_max = self.z_max()
 
         z_incr = float(self.config["quality"])
         
         if verbose:
             print(" Slicing height is " + str(z_max) + "mm", file = sys.stderr)
             
-        # Slicing loop
-        slices = []
+        # Slicing loop, finished layers are spilled to disk in out-of-core mode
+        if self.config["outofcore"]["enabled"]:
+            slices = LayerStore(self.config, self.models)
+        else:
+            slices = []
 
         start_loop = timer()
 
         for z in np.arange(0, z_max, z_incr):
 
-            slice = []
-            
-            for m in self.models:
-                if self.config["verbose"]:
-                    print(" {:3.2f}%".format(z / z_max * 100.0), end = "", file = sys.stderr)
-                    print("\b\b\b\b\b\b\b\b", end = "", file = sys.stderr)
-                    sys.stderr.flush()
-
-                m.set_slicing_plan(z)
-                
-                segs = []
-
-                xmin, ymin = 99999.0, 99999.0
-                xmax, ymax = 0.0, 0.0
-                
-                for facet in m.intersect:
-                    (n, xa, ya, xb, yb) = self.slice_facet(facet, z)
-
-                    if n == 2:
-                        if not fequals(xa, xb) or not fequals(ya, yb):
-                            xmin = min(xmin, min(xa, xb))
-                            ymin = min(ymin, min(ya, yb))
-                            xmax = max(xmax, max(xa, xb))
-                            ymax = max(ymax, max(ya, yb))
-                            segs.append((xa, ya, xb, yb))
-                    else:
-                        continue
-                
-                if len(segs) > 0:
-                    slice.append([ xmin, ymin, xmax, ymax, segs ])
+            if self.config["verbose"]:
+                print(" {:3.2f}%".format(z / z_max * 100.0), end = "", file = sys.stderr)
+                print("\b\b\b\b\b\b\b\b", end = "", file = sys.stderr)
+                sys.stderr.flush()
 
+            slice = self.slice_layer(z)
             slices.append(slice)
             
         end_loop = timer()
@@ -174,3 +197,62 @@ class Slicer:
 
         return slices
 
+class SlicedModel:
+    """ Random access to the layers of a scene, layers are sliced, optimized and filled on demand """
+
+    def __init__(self, config, models):
+        """ Constructor, arranges the models on the plate """
+        self.config = config
+
+        self.slicer = Slicer(config, models)
+        self.slicer.arrange()
+        self.optimizer = Optimizer(config)
+
+        self.z_incr = float(self.config["quality"])
+        self.count = len(np.arange(0, self.slicer.z_max(), self.z_incr))
+
+        # Most recently used layers
+        self.cache = OrderedDict()
+        self.cache_size = self.config["preview"]["cache_layers"]
+
+    def __len__(self):
+        return self.count
+
+    def height(self, i):
+        """ Returns the slicing height of layer i """
+        return i * self.z_incr
+
+    def layer(self, i):
+        """ Returns layer i as a list of [ xmin, ymin, xmax, ymax, paths, model, infill ] where infill is a list of polylines """
+
+        if i < 0:
+            i += self.count
+
+        if i < 0 or i >= self.count:
+            raise IndexError("layer index out of range")
+
+        if i in self.cache:
+            self.cache.move_to_end(i)
+            return self.cache[i]
+
+        regions = []
+
+        for xmin, ymin, xmax, ymax, segs, model in self.slicer.slice_layer(self.height(i)):
+            paths = self.optimizer.simplify(self.optimizer.points_from_segments(segs))
+
+            filling = infill(paths, xmin, ymin, xmax, ymax, self.config["infill_pattern"], self.config["filling_percent"] / 100.0,
+                             self.config["extruder"]["nozzle_diameter"], i, self.height(i))
+
+            regions.append([ xmin, ymin, xmax, ymax, paths, model, filling ])
+
+        self.cache[i] = regions
+
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last = False)
+
+        return regions
+
+    def layers(self, indices):
+        """ Returns the layers of an iterable of indices, e.g. a range """
+        return [ self.layer(i) for i in indices ]
+
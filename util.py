@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 
 import math
+import numpy as np
 
 def fequals(a, b, tolerance = 0.000001):
     """ Returns true if a (almost) equals b according to the given tolerance """
@@ -24,3 +25,132 @@ def colinear2d(x0, y0, x1, y1, x2, y2):
     u1, v1 = [ u[0] / ulen, u[1] / ulen ], [ v[0] / vlen, v[1] / vlen ]
     
     return fequals(1, abs(u1[0] * v1[0] + u1[1] * v1[1]))
+
+def simplify2d(points, tolerance):
+    """ Simplifies a 2d polyline with the Douglas-Peucker algorithm.
+        Points closer than 'tolerance' to the simplified polyline are dropped, endpoints are always kept. """
+
+    n = len(points)
+
+    if n < 3 or tolerance <= 0:
+        return points
+
+    pts = np.asarray(points, dtype = float)
+    keep = np.zeros(n, dtype = bool)
+    keep[0] = keep[-1] = True
+
+    # A closed path has identical endpoints, split it on its farthest point
+    if fequals(pts[0][0], pts[-1][0]) and fequals(pts[0][1], pts[-1][1]):
+        k = int(np.argmax(np.hypot(pts[:, 0] - pts[0][0], pts[:, 1] - pts[0][1])))
+        keep[k] = True
+        stack = [ (0, k), (k, n - 1) ]
+    else:
+        stack = [ (0, n - 1) ]
+
+    while len(stack) > 0:
+        i, j = stack.pop()
+
+        if j - i < 2:
+            continue
+
+        # Distance of the inner points to the segment [i, j]
+        ab = pts[j] - pts[i]
+        d = pts[i + 1:j] - pts[i]
+        l2 = ab[0] * ab[0] + ab[1] * ab[1]
+
+        if fequals(l2, 0):
+            dist = np.hypot(d[:, 0], d[:, 1])
+        else:
+            t = np.clip((d[:, 0] * ab[0] + d[:, 1] * ab[1]) / l2, 0.0, 1.0)
+            dist = np.hypot(d[:, 0] - t * ab[0], d[:, 1] - t * ab[1])
+
+        k = int(np.argmax(dist))
+
+        if dist[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+
+    return [ points[k] for k in np.flatnonzero(keep) ]
+
+def circle2d(x0, y0, x1, y1, x2, y2):
+    """ Returns the center and the radius of the circle through three 2d points, None if they are colinear """
+
+    d = 2 * (x0 * (y1 - y2) + x1 * (y2 - y0) + x2 * (y0 - y1))
+
+    if fequals(d, 0):
+        return None
+
+    s0, s1, s2 = x0 * x0 + y0 * y0, x1 * x1 + y1 * y1, x2 * x2 + y2 * y2
+    cx = (s0 * (y1 - y2) + s1 * (y2 - y0) + s2 * (y0 - y1)) / d
+    cy = (s0 * (x2 - x1) + s1 * (x0 - x2) + s2 * (x1 - x0)) / d
+
+    return cx, cy, math.hypot(x0 - cx, y0 - cy)
+
+def fit_arc2d(pts, tolerance, max_radius = 1000.0):
+    """ Tries to fit a circular arc through all the points of the numpy array 'pts'.
+        Returns (cx, cy, r, sweep) where sweep is the signed angle (> 0 counter-clockwise) or None. """
+
+    mid = len(pts) // 2
+    circle = circle2d(pts[0][0], pts[0][1], pts[mid][0], pts[mid][1], pts[-1][0], pts[-1][1])
+
+    if circle is None or circle[2] > max_radius:
+        return None
+
+    cx, cy, r = circle
+    dx, dy = pts[:, 0] - cx, pts[:, 1] - cy
+
+    # Vertices and chord midpoints must lay on the circle
+    if np.max(np.abs(np.hypot(dx, dy) - r)) > tolerance:
+        return None
+
+    mx, my = (dx[1:] + dx[:-1]) / 2, (dy[1:] + dy[:-1]) / 2
+
+    if np.max(r - np.hypot(mx, my)) > tolerance:
+        return None
+
+    # The points must turn around the center in a single direction
+    da = np.diff(np.arctan2(dy, dx))
+    da = (da + math.pi) % (2 * math.pi) - math.pi
+
+    if not (np.all(da > 0) or np.all(da < 0)):
+        return None
+
+    sweep = float(np.sum(da))
+
+    if abs(sweep) >= 2 * math.pi - 0.001:
+        return None
+
+    return cx, cy, r, sweep
+
+def fit_arcs2d(points, tolerance, min_points = 4):
+    """ Converts a polyline into a list of moves (x, y, arc) where arc is None for a straight move
+        or (i, j, clockwise, length) for a circular move, (i, j) being the center relative to the start point. """
+
+    pts = np.asarray(points, dtype = float)
+    n = len(pts)
+    moves = []
+
+    i = 0
+    while i < n - 1:
+        best = None
+        j = i + min_points - 1
+
+        # Greedily extends the arc as long as the points fit
+        while j < n:
+            arc = fit_arc2d(pts[i:j + 1], tolerance)
+            if arc is None:
+                break
+            best = (j, arc)
+            j += 1
+
+        if best is None:
+            moves.append((points[i + 1][0], points[i + 1][1], None))
+            i += 1
+        else:
+            j, (cx, cy, r, sweep) = best
+            moves.append((points[j][0], points[j][1], (cx - pts[i][0], cy - pts[i][1], sweep < 0, r * abs(sweep))))
+            i = j
+
+    return moves